@@ -16,7 +16,7 @@ designed to retrieve or modify data tersely.
         image.height *= 2
         image.width *= 2
         image.parent.append(img(a('(original)', href=image.href)))
-    rows = doc.getattrs('findall_td.parents', iter([ ]))
+    rows = iter(doc.getattrs('findall_td.parents', [ ]))
     try:
         while True:
             rows.next().bgcolor = '#000000'
@@ -27,9 +27,17 @@ designed to retrieve or modify data tersely.
     print repr(doc)                         # Python rendition
 """
 
+import bisect
+import marshal
+import os
 import re
 import sys
+import threading
+import time
 import UserDict
+import weakref
+from array import array
+from collections import deque
 
 # type tools
 
@@ -44,7 +52,7 @@ def is_sequence(l):
     return isinstance(l, tuple) or isinstance(l, list)
 
 def is_entity(e):
-    return (isinstance(e, entity)
+    return (isinstance(e, (entity, frozen_entity))
             or (isinstance(e, cursor) and is_entity(e.delegate)))
 
 def is_tag(t):
@@ -65,11 +73,20 @@ def quote_identifier(s):
     else:
         return s
 
+# one scan tells whether there is anything to replace at all
+sgml_special = re.compile('[&<>]').search
+sgml_special_or_quote = re.compile('[&<>"]').search
+
 def sgml_escape(s):
+    if sgml_special(s) is None:
+        return s
     return s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
 
 def sgml_escape_quotes_too(s):
-    return sgml_escape(s).replace('"', '&quot;')
+    if sgml_special_or_quote(s) is None:
+        return s
+    return (s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+            .replace('"', '&quot;'))
 
 def substfmt(value, format, equals_format='', test_value=''):
     # example usage:
@@ -139,6 +156,111 @@ def last(iterable):
         except StopIteration:
             return value
 
+class lru(object):
+    """bounded mapping that forgets the least recently used entries.
+
+    lru.get(KEY, DEFAULT)
+    lru[KEY] = VALUE
+    lru.hits, lru.misses
+
+    Safe to use from several threads at once.
+    """
+    def __init__(self, size=1024):
+        self.size = size
+        self.lock = threading.Lock()
+        self.clear()
+    def clear(self):
+        self.lock.acquire()
+        try:
+            # links are [ PREVIOUS, NEXT, KEY, VALUE ], oldest after root
+            self.root = [ None, None, None, None ]
+            self.root[0] = self.root[1] = self.root
+            self.links = { }
+            self.hits = 0
+            self.misses = 0
+        finally:
+            self.lock.release()
+    def __len__(self):
+        return len(self.links)
+    def __contains__(self, key):
+        return key in self.links
+    def get(self, key, default=None):
+        self.lock.acquire()
+        try:
+            link = self.links.get(key)
+            if link is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.unlink(link)
+            self.append(link)
+            return link[3]
+        finally:
+            self.lock.release()
+    def __setitem__(self, key, value):
+        self.lock.acquire()
+        try:
+            link = self.links.get(key)
+            if link is not None:
+                self.unlink(link)
+            elif len(self.links) >= self.size:
+                oldest = self.root[1]
+                self.unlink(oldest)
+                del self.links[oldest[2]]
+            link = [ None, None, key, value ]
+            self.links[key] = link
+            self.append(link)
+        finally:
+            self.lock.release()
+    def unlink(self, link):
+        link[0][1] = link[1]
+        link[1][0] = link[0]
+    def append(self, link):
+        newest = self.root[0]
+        link[0] = newest
+        link[1] = self.root
+        newest[1] = link
+        self.root[0] = link
+
+class statistics(object):
+    """opt-in counters and timers for searching, parsing and rendering.
+
+    with stats:                   # reset, collect, stop
+        ...
+    stats.counters                => { NAME: COUNT }
+    stats.timers                  => { NAME: SECONDS }
+    print stats
+
+    While disabled, the instrumented code only tests stats.enabled.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+    def reset(self):
+        self.counters = { }
+        self.timers = { }
+    def enable(self):
+        self.enabled = True
+    def disable(self):
+        self.enabled = False
+    def __enter__(self):
+        self.reset()
+        self.enable()
+        return self
+    def __exit__(self, *exc_info):
+        self.disable()
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+    def add_time(self, name, seconds):
+        self.timers[name] = self.timers.get(name, 0.0) + seconds
+    def __str__(self):
+        return '\n'.join(
+            [ '%-32s %12d' % item for item in sorted(self.counters.items()) ]
+            + [ '%-32s %11.3fs' % item
+                for item in sorted(self.timers.items()) ])
+
+stats = statistics()
+
 # exceptions
 
 class AttributeExists: pass
@@ -147,6 +269,15 @@ class RaiseSomething: pass
 
 args_re = re.compile('([^_]+_?)(?:_|$)')
 
+def described(fn, *form):
+    """tags the criterion FN with its FORM, e.g. ('attribute', ATTR, VALUE),
+    so that and_/or_ can see through it when compiling."""
+    fn.criterion = form
+    return fn
+
+def criterion_form(fn):
+    return getattr(fn, 'criterion', None) or ('lambda', fn)
+
 class criterion:
     """curries for specifying a condition.
 
@@ -159,9 +290,13 @@ class criterion:
     criterion.slice3(M, N, I)
     criterion.substring('STRING')
     criterion.regexp('(PATTERN)')
-    criterion.and_(CRITERIA)      => reduce(and, CRITERIA)
-    criterion.or_(CRITERIA)       => reduce(or, CRITERIA)
+    criterion.and_(CRITERIA)      => all(CRITERIA), short-circuited
+    criterion.or_(CRITERIA)       => any(CRITERIA), short-circuited
     criterion.attribute('ATTR', 'VALUE')
+    criterion.token('ATTR', 'WORD')  => WORD in ATTR.split()
+    criterion.outside(CRITERION, 'TAG'...)
+                                  => CRITERION, not searched for
+                                     within TAG entities
     criterion.ATTR('VALUE')
     criterion.TAG                 => criterion.tag('TAG')
     criterion.has_ATTR            => criterion.ATTR(AttributeExists)
@@ -180,26 +315,105 @@ class criterion:
     #def slice3(self, m, n, i):
     #    return self.slice1(slice(m, n, i))
     def substring(self, substring):
-        return lambda item: is_string(item) and substring in item
+        return described(lambda item: is_string(item) and substring in item,
+                         'substring', substring)
     #def regexp(self, regexp):
     #    if is_string(regexp):
     #        regexp = re.compile(regexp)
     #    return lambda item: is_string(item) and regexp.search(item)
     def and_(self, *criteria):
-        and_lambda = lambda a, b: a and b
-        return lambda item: reduce(and_lambda, [ c(item) for c in criteria ]) 
+        # compiled once: nested and_'s are flattened, the attribute
+        # tests (tag first) share one attributes lookup and run before
+        # any other criteria, and evaluation stops at the first miss.
+        criteria = self.flatten('and', criteria)
+        tests = [ ]
+        others = [ ]
+        for c in criteria:
+            form = criterion_form(c)
+            if form[0] == 'attribute':
+                if form[1] == 'tag':
+                    tests.insert(0, form[1:])
+                else:
+                    tests.append(form[1:])
+            else:
+                others.append(c)
+        def and_(item):
+            if tests:
+                if not is_entity(item):
+                    return False
+                get = item.get
+                for attr, value in tests:
+                    if value is AttributeExists:
+                        if get(attr, AttributeNonexistent) is AttributeNonexistent:
+                            return False
+                    elif get(attr, AttributeNonexistent) != value:
+                        return False
+            for c in others:
+                if not c(item):
+                    return False
+            return True
+        return described(and_, 'and', *criteria)
     def or_(self, *criteria):
-        or_lambda = lambda a, b: a or b
-        return lambda item: reduce(or_lambda, [ c(item) for c in criteria ]) 
+        # compiled once: nested or_'s are flattened, alternative tags
+        # become one set lookup, and evaluation stops at the first hit.
+        criteria = self.flatten('or', criteria)
+        tags = set()
+        others = [ ]
+        for c in criteria:
+            form = criterion_form(c)
+            if (form[0] == 'attribute' and form[1] == 'tag'
+                and isinstance(form[2], basestring)):
+                tags.add(form[2])
+            else:
+                others.append(c)
+        def or_(item):
+            if tags and is_entity(item) and item.get('tag') in tags:
+                return True
+            for c in others:
+                if c(item):
+                    return True
+            return False
+        return described(or_, 'or', *criteria)
+    def outside(self, criterion, *tags):
+        fn = lambda item: criterion(item)
+        return described(fn, 'outside', criterion, frozenset(tags))
+    def flatten(self, op, criteria):
+        flat = [ ]
+        for c in criteria:
+            form = criterion_form(c)
+            if form[0] == op:
+                flat.extend(form[1:])
+            else:
+                flat.append(c)
+        return flat
     def attribute(self, attr, value=AttributeExists):
         if value is AttributeExists:
-            return lambda item: is_entity(item) and attr in item.attributes
+            fn = lambda item: (
+                is_entity(item)
+                and item.get(attr, AttributeNonexistent) is not AttributeNonexistent
+                )
         else:
-            return lambda item: (
+            fn = lambda item: (
                 is_entity(item)
-                and item.attributes.get(attr, AttributeNonexistent) == value
+                and item.get(attr, AttributeNonexistent) == value
                 )
+        return described(fn, 'attribute', attr, value)
+    def token(self, attr, word):
+        def token(item):
+            if not is_entity(item):
+                return False
+            value = item.get(attr)
+            return is_string(value) and word in value.split()
+        return described(token, 'token', attr, word)
     def __getattr__(self, attr):
+        # the names are parsed once and remembered in criterion_names
+        key = (self.__class__, attr)
+        fn = criterion_names.get(key, RaiseSomething)
+        if fn is RaiseSomething:
+            fn = self.resolve(attr)
+            criterion_names[key] = fn
+        return fn
+    def resolve(self, attr):
         # criterion.body  =>  criterion.tag(body)
         if is_tag(attr):
             assert(attr != 'tag')
@@ -221,10 +435,41 @@ class criterion:
                 attr = dequote_identifier(attr)
                 return lambda value=AttributeExists: self.attribute(attr, value)
 by = criterion()
+criterion_names = lru(1024)
+
+def criterion_prunes(fn):
+    """the tags FN declares it never matches within, see outside()."""
+    form = criterion_form(fn)
+    if form[0] == 'outside':
+        return form[2] | criterion_prunes(form[1])
+    elif form[0] == 'and':
+        # one part never matching is enough
+        return frozenset().union(*[ criterion_prunes(c) for c in form[1:] ])
+    elif form[0] == 'or' and len(form) > 1:
+        # every part has to never match
+        return reduce(frozenset.intersection,
+                      [ criterion_prunes(c) for c in form[1:] ])
+    return frozenset()
 
-class mixin: pass
+def pruning(prune, fn):
+    """(TAGS, LAMBDA) of the entities not to search within, from
+    findall()'s PRUNE and what FN declares; either may be None."""
+    tags = criterion_prunes(fn)
+    if prune is None:
+        pass
+    elif callable(prune):
+        return tags or None, prune
+    elif is_string(prune):
+        tags = tags | frozenset((prune,))
+    else:
+        tags = tags | frozenset(prune)
+    return tags or None, None
+
+class mixin(object):
+    __slots__ = ()
 
 class renderable(mixin):
+    __slots__ = ()
     def __str__(self):
         # XXX return self.as_html(path(self))
         return self.as_html()
@@ -255,6 +500,11 @@ class searchable(mixin):
     searchable.matchall(LAMBDA)
     searchable.search(LAMBDA, DEPTH)
     searchable.findall(LAMBDA, NEST, DEPTH) => MATCHES
+    searchable.iter_findall(LAMBDA, NEST, DEPTH) => iter([ CURSOR... ])
+    searchable.findall(LAMBDA, prune=LAMBDA or [ 'TAG'... ])
+                                  => MATCHES, not searching within the
+                                     entities PRUNE is true for or
+                                     tagged e.g. skip_non_content
 
     searchable.match_by_CRITERION_PARAMS
     searchable.matchall_by_CRITERION_PARAMS
@@ -270,7 +520,10 @@ class searchable(mixin):
     searchable.all_TAG
 
     searchable.getattrs(ATTRS, default=raise)
+
+    searchable.select('CSS SELECTOR') => MATCHES
     """
+    __slots__ = ()
     def __contains__(self, item):
         #print "searchable __contains__"
         if isinstance(item, type):
@@ -283,7 +536,7 @@ class searchable(mixin):
                 return False
         elif is_string(item):
             #print "searchable __contains__ string"
-            return item in self.as_text()
+            return text_contains(self.iter_text(), item)
         else:
             #print "searchable __contains__ ?"
             return False
@@ -300,51 +553,120 @@ class searchable(mixin):
     def slice3(self, m, n, i):
         return slice3(m, n, i, self)
     def match(self, fn):
-        return self.matchall(fn).next()
+        return self.iter_findall(fn, nest=0, max_depth=1).next()
     def matchall(self, fn):
         return self.findall(fn, nest=0, max_depth=1)
-    def search(self, fn, max_depth=sys.maxint):
-        return self.findall(fn, nest=0, max_depth=max_depth).next()
-    def findall(self, fn, nest=1, min_depth=1, max_depth=sys.maxint, depth_first=True):
+    def search(self, fn, max_depth=sys.maxint, prune=None):
+        return self.iter_findall(fn, nest=0, max_depth=max_depth,
+                                 prune=prune).next()
+    def findall(self, fn, nest=1, min_depth=1, max_depth=sys.maxint,
+                depth_first=True, prune=None):
+        return matches(self.iter_findall(fn, nest, min_depth, max_depth,
+                                         depth_first, prune))
+    def iter_findall(self, fn, nest=1, min_depth=1, max_depth=sys.maxint,
+                     depth_first=True, prune=None):
+        skip, prune = pruning(prune, fn)
+        if isinstance(self, cursor) and isinstance(self.delegate,
+                                                   frozen_entity):
+            for c in self.delegate.document.iter_findall(
+                self, fn, nest, min_depth, max_depth, depth_first, skip,
+                prune):
+                yield c
+            return
+        counting = stats.enabled
+        if isinstance(self, entity) and self._index is not None:
+            found = self.tree_index().findall(fn, nest, min_depth, max_depth,
+                                              depth_first, skip, prune)
+            if found is not None:
+                if counting:
+                    stats.count('findall index lookups')
+                for c in found:
+                    yield c
+                return
         if isinstance(self, cursor):
-            work = [ self ]
+            root = self
+            cursors = 0
         else:
-            work = [ cursor(self, path(), None) ]
-        while work:
-            e = work.pop(0)
-            if len(e.ancestors) >= min_depth:
-                if fn(e):
-                    yield e
+            root = cursor(self, None, None, 0)
+            cursors = 1
+        visited = tested = 0
+        try:
+            depth = root.depth
+            if counting:
+                visited += 1
+            if depth >= min_depth:
+                if counting:
+                    tested += 1
+                if fn(root):
+                    yield root
                     if not nest:
-                        continue
-            if len(e.ancestors) < max_depth:
-                if is_entity(e):
-                    # "magically" wraps each item in its contents with
-                    # another cursor() proxy with its relative position.
-                    new_work = list(e)
-                    if depth_first:
-                        work = new_work + work
-                    else:
-                        work += new_work
+                        return
+            if (depth >= max_depth or not is_entity(root)
+                or (skip and root.tag in skip) or (prune and prune(root))):
+                return
+            # each entity being searched, with an iterator over (a copy
+            # of) its contents: the cursor() proxies linked to it are
+            # made as the search gets to them, so a search() that stops
+            # early has made no more than it looked at
+            work = [ (root, enumerate(list(root.delegate)), depth + 1) ]
+            if depth_first:
+                take = work.pop
+            else:
+                work = deque(work)
+                take = work.popleft
+            while work:
+                parent, children, depth = take()
+                for i, c in children:
+                    e = cursor(c, parent, i, depth)
+                    if counting:
+                        visited += 1
+                        cursors += 1
+                    if depth >= min_depth:
+                        if counting:
+                            tested += 1
+                        if fn(e):
+                            yield e
+                            if not nest:
+                                continue
+                    if (depth < max_depth and is_entity(c)
+                        and not (skip and c.tag in skip)
+                        and not (prune and prune(e))):
+                        grandchildren = (e, enumerate(list(c)), depth + 1)
+                        if depth_first:
+                            # back to the rest of the children afterwards
+                            work.append((parent, children, depth))
+                            work.append(grandchildren)
+                            break
+                        work.append(grandchildren)
+        finally:
+            if counting:
+                stats.count('findall nodes visited', visited)
+                stats.count('findall predicate calls', tested)
+                stats.count('findall cursors created', cursors)
+    def select(self, selector):
+        fn = selectors.get(selector)
+        if fn is None:
+            fn = selectors[selector] = compile_selector(selector)
+        return self.findall(fn)
     def __getattr__(self, attr):
         #print "searchable __getattr__ %s" % attr
-        if '_' in attr:
-            firstword, rest = attr.split('_', 1)
-            if firstword in ('slice1' 'slice2', 'slice3', 'nth'):
-                return getattr(self, firstword)(map(int, rest.split('_')))
-            elif firstword in ('match', 'matchall', 'search', 'findall'):
-                return getattr(self, firstword)(getattr(by, rest))
-            elif attr.startswith('all_'):
-                return list(self.findall(getattr(by, rest)))
-            else:
-                raise AttributeError, attr
-        elif is_tag(attr):
+        # the names are parsed once and remembered in searchable_names
+        operation = searchable_names.get(attr)
+        if operation is None:
+            operation = searchable_operation(attr)
+            searchable_names[attr] = operation
+        method, arg = operation
+        if method is None:
+            raise AttributeError, attr
+        elif method == 'all':
+            return list(self.findall(arg))
+        elif method == 'tag':
             try:
-                return self.match(by.tag(attr))
+                return self.match(arg)
             except StopIteration:
                 raise AttributeError, attr
         else:
-            raise AttributeError, attr
+            return getattr(self, method)(arg)
     def getattrs(self, attrs, default=RaiseSomething):
         if is_string(attrs):
             attrs = attrs.split('.')
@@ -355,7 +677,168 @@ class searchable(mixin):
                 raise
         return default
 
-class entity(object, UserDict.DictMixin, searchable, renderable):
+def searchable_operation(attr):
+    """parses a searchable.__getattr__ name into (METHOD, ARGUMENT)."""
+    if '_' in attr:
+        firstword, rest = attr.split('_', 1)
+        if firstword in ('slice1' 'slice2', 'slice3', 'nth'):
+            return firstword, map(int, rest.split('_'))
+        elif firstword in ('match', 'matchall', 'search', 'findall'):
+            return firstword, getattr(by, rest)
+        elif attr.startswith('all_'):
+            return 'all', getattr(by, rest)
+        else:
+            return None, None
+    elif is_tag(attr):
+        return 'tag', by.tag(attr)
+    else:
+        return None, None
+
+searchable_names = lru(1024)
+
+# css selectors
+
+selector_re = re.compile(r'''
+      \s*([>+~,])\s*                       # combinator or group
+    | (\s+)                                # descendant combinator
+    | (\*|[\w-]+)                          # tag
+    | \#([\w-]+)                           # id
+    | \.([\w-]+)                           # class
+    | \[\s*([\w-]+)\s*(?:([~]?=)\s*        # attribute
+          (?:"([^"]*)"|'([^']*)'|([^\]\s]*))\s*)?\]
+    | :([\w-]+)(?:\(\s*(\d+)\s*\))?        # pseudo class
+    ''', re.VERBOSE)
+
+def compile_selector(selector):
+    """compiles a CSS SELECTOR into a criterion for findall().
+
+    tag, *, #id, .class, [attr], [attr=value], [attr~=word],
+    :first-child, :last-child and :nth-child(N) compounds, joined by
+    the descendant, child (>), adjacent (+) and general (~) sibbling
+    combinators, in comma separated groups.
+    """
+    groups = [ ]
+    compounds = [ [ ] ]
+    combinators = [ ]
+    text = selector.strip()
+    pos = 0
+    while pos < len(text):
+        m = selector_re.match(text, pos)
+        if m is None:
+            raise ValueError, 'bad selector %r at %d' % (selector, pos)
+        pos = m.end()
+        (combinator, space, tag, id_, class_, attr, op, dquoted, squoted,
+         unquoted, pseudo, arg) = m.groups()
+        terms = compounds[-1]
+        if combinator == ',':
+            groups.append(selector_chain(selector, compounds, combinators))
+            compounds = [ [ ] ]
+            combinators = [ ]
+        elif combinator or space:
+            combinators.append(combinator or ' ')
+            compounds.append([ ])
+        elif tag == '*':
+            terms.append(by.attribute('tag'))
+        elif tag:
+            terms.append(by.attribute('tag', tag.lower()))
+        elif id_:
+            terms.append(by.attribute('id', id_))
+        elif class_:
+            terms.append(by.token('class', class_))
+        elif attr:
+            attr = attr.lower()
+            if op is None:
+                terms.append(by.attribute(attr))
+            else:
+                for value in (dquoted, squoted, unquoted):
+                    if value is not None:
+                        break
+                if op == '=':
+                    terms.append(by.attribute(attr, value))
+                else:
+                    terms.append(by.token(attr, value))
+        elif pseudo == 'first-child':
+            terms.append(lambda c: child_position(c) == 1)
+        elif pseudo == 'last-child':
+            terms.append(lambda c: child_position(c, from_end=True) == 1)
+        elif pseudo == 'nth-child' and arg is not None:
+            n = int(arg)
+            terms.append(lambda c: child_position(c) == n)
+        else:
+            raise ValueError, 'unsupported selector %r' % (m.group(),)
+    groups.append(selector_chain(selector, compounds, combinators))
+    if len(groups) == 1:
+        return groups[0]
+    else:
+        return by.or_(*groups)
+
+def selector_chain(selector, compounds, combinators):
+    """criterion matching the rightmost compound, then checking the
+    others leftwards through the cursor's ancestors and sibblings."""
+    if [ ] in compounds:
+        raise ValueError, 'bad selector %r' % (selector,)
+    # only entities match, whatever the compound
+    tests = [ by.and_(by.attribute('tag'), *terms)
+              for terms in reversed(compounds) ]
+    combinators = list(reversed(combinators))
+    def matches_from(k, c):
+        if k == len(tests):
+            return True
+        combinator = combinators[k - 1]
+        test = tests[k]
+        if combinator == '>':
+            c = c.parent
+            return c is not None and test(c) and matches_from(k + 1, c)
+        elif combinator == ' ':
+            c = c.parent
+            while c is not None:
+                if test(c) and matches_from(k + 1, c):
+                    return True
+                c = c.parent
+            return False
+        else:
+            c = previous_entity(c)
+            while c is not None:
+                if test(c) and matches_from(k + 1, c):
+                    return True
+                elif combinator == '+':
+                    return False
+                c = previous_entity(c)
+            return False
+    if len(tests) == 1:
+        return tests[0]
+    else:
+        # the rightmost compound's attribute tests are hoisted by and_
+        return by.and_(tests[0], lambda c: matches_from(1, c))
+
+def previous_entity(c):
+    """cursor to the closest preceding sibbling entity of cursor C."""
+    parent = c.parent
+    if parent is None or not isinstance(c.which_child, int):
+        return None
+    for i in xrange(c.which_child - 1, -1, -1):
+        if is_entity(parent.delegate[i]):
+            return parent[i]
+    return None
+
+def child_position(c, from_end=False):
+    """1-based position of cursor C among its sibbling entities."""
+    parent = c.parent
+    if parent is None or not isinstance(c.which_child, int):
+        return None
+    if from_end:
+        sibblings = parent.delegate[c.which_child:]
+    else:
+        sibblings = parent.delegate[:c.which_child + 1]
+    n = 0
+    for x in sibblings:
+        if is_entity(x):
+            n += 1
+    return n
+
+selectors = lru(256)
+
+class entity(searchable, renderable):
     """structured recursive container with tag, attributes, and contents.
 
     dict methods access of attributes, e.g.:
@@ -383,16 +866,33 @@ class entity(object, UserDict.DictMixin, searchable, renderable):
     rendering (see renderable):
       str(entity)                   => entity.as_html()
       repr(entity)                  => entity.as_python()
+      entity.as_html(FILE)          => FILE.write(...) in chunks
+      entity.iter_html()            => iter([ '<TAG>', ..., '</TAG>' ])
       entity.as_text()
+      entity.cache_rendering()      => keep renditions until edited
+      entity.dumps()                => loads() can rebuild it from this
+      entity.freeze()               => FROZEN_ENTITY, see frozen_document
+
+    The attributes are kept as a flat (KEY, VALUE, ...) tuple, shared
+    by all entities with only a tag, until entity.attributes is asked
+    for; from then on that attributes dict holds them.
     """
+    __slots__ = ('contents', '_tag', '_attributes', '_index', '_cache')
     module_prefix = __name__ + '.'
     def __init__(self, *flow, **attrs):
         if 'tag' in attrs:
-            self.__dict__['attributes'] = attributes(**attrs)
-        else:
+            pairs = attribute_pairs(keywords(**attrs).iteritems())
+        elif attrs:
             tag = dequote_identifier(self.__class__.__name__)
-            self.__dict__['attributes'] = attributes(tag=tag, **attrs)
-        self.__dict__['contents'] = contents(flow)
+            pairs = attribute_pairs(keywords(tag=tag, **attrs).iteritems())
+        else:
+            pairs = tag_pairs(dequote_identifier(self.__class__.__name__))
+        setslot = object.__setattr__
+        setslot(self, 'contents', contents(flow))
+        setslot(self, '_attributes', pairs)
+        setslot(self, '_tag', self.get_attribute('tag'))
+        setslot(self, '_index', None)
+        setslot(self, '_cache', None)
     #def __lt__(self, other):
     #    # XXX compare self.attributes?
     #    return self.contents < self.__cast(other)
@@ -415,10 +915,11 @@ class entity(object, UserDict.DictMixin, searchable, renderable):
         #print "entity __cmp__"
         return (cmp(type(self), type(other))
                 or cmp(self.contents, other.contents)
-                or cmp(self.attributes, other.attributes))
+                or cmp(self.attribute_dict(), other.attribute_dict()))
     def __contains__(self, item):
         #print "entity __contains__"
-        if item in self.attributes:
+        if (self.get_attribute(item, AttributeNonexistent)
+            is not AttributeNonexistent):
             #print "entity __contains__ in attributes"
             return True
         elif item in self.contents:
@@ -434,8 +935,10 @@ class entity(object, UserDict.DictMixin, searchable, renderable):
     def __getitem__(self, key):
         if is_index_or_slice(key):
             return self.contents[key]
-        else:
-            return self.attributes[key]
+        value = self.get_attribute(key, AttributeNonexistent)
+        if value is AttributeNonexistent:
+            raise KeyError, key
+        return value
     def __setitem__(self, key, value):
         if is_index_or_slice(key):
             self.contents[key] = value
@@ -510,12 +1013,146 @@ class entity(object, UserDict.DictMixin, searchable, renderable):
             self.contents.extend(other.contents)
         else:
             self.contents.extend(other)
+    def __getstate__(self):
+        return { 'contents': self.contents, 'tag': self._tag,
+                 'attributes': self._attributes }
+    def __setstate__(self, state):
+        setslot = object.__setattr__
+        setslot(self, 'contents', state['contents'])
+        setslot(self, '_tag', state.get('tag'))
+        setslot(self, '_attributes', state['attributes'])
+        setslot(self, '_index', None)
+        setslot(self, '_cache', None)
+    def __reduce_ex__(self, protocol):
+        # tag classes pickle by tag: their names (object, map...) are
+        # not always html module globals
+        cls = self.__class__
+        if getattr(entities, quote_identifier(cls.__name__), None) is cls:
+            cls = cls.__name__
+        return (new_entity, (cls,), self.__getstate__())
+    def dumps(self):
+        return dumps(self)
+    def freeze(self):
+        return freeze(self)
+    def cache_rendering(self, enabled=True):
+        """keeps as_html() and as_text() results until edited.
+
+        Each entity under this one remembers its renditions.  Editing
+        an entity's contents or attributes forgets those of the entity
+        and its ancestors, so rendering again redoes only that path.
+        """
+        cache = self._cache
+        if enabled:
+            if type(cache) is not root_cache:
+                cache_root(self)
+            return
+        if cache is None:
+            return
+        if type(cache) is root_cache:
+            render_caches.pop(id(cache), None)
+        # whatever this is within has these renditions in its own
+        uncache(self)
+        work = [ self ]
+        while work:
+            e = work.pop()
+            if e._cache is not None:
+                object.__setattr__(e, '_cache', None)
+                object.__setattr__(e.contents, '_owner', None)
+                if type(e._attributes) is not tuple:
+                    e._attributes.__dict__.pop('_owner', None)
+                work.extend([ c for c in e.contents if isinstance(c, entity) ])
+    def tree_index(self):
+        """the tree_index of this entity, (re)built when missing or stale.
+
+        Once asked for, findall() and match() answer simple tag, id
+        and class criteria from it instead of walking the tree.
+        """
+        index = self._index
+        if index is None or index.stale():
+            index = tree_index(self)
+            object.__setattr__(self, '_index', index)
+        return index
+    def get_attributes(self):
+        a = self._attributes
+        if type(a) is tuple:
+            a = self.attribute_dict()
+            object.__setattr__(self, '_attributes', a)
+            if self._cache is not None:
+                a.__dict__['_owner'] = self
+            if tree_indexes:
+                indexed_attributes(self, a)
+        return a
+    attributes = property(get_attributes)
+    def attribute_dict(self):
+        """the attributes, without making entity.attributes hold them."""
+        a = self._attributes
+        if type(a) is tuple:
+            pairs = a
+            a = attributes()
+            for i in xrange(0, len(pairs), 2):
+                dict.__setitem__(a, pairs[i], pairs[i + 1])
+        return a
+    def attribute_items(self):
+        """[ (ATTR, VALUE)... ] except the tag, in attributes order."""
+        a = self._attributes
+        if type(a) is tuple:
+            if len(a) <= 4:
+                # the tag and at most one more: no order to work out
+                return [ (a[i], a[i + 1]) for i in xrange(0, len(a), 2)
+                         if a[i] != 'tag' ]
+            a = dict(zip(a[::2], a[1::2]))
+        return [ (k, a[k]) for k in a if k != 'tag' ]
+    def get(self, key, default=None):
+        if is_index_or_slice(key):
+            return self.contents[key]
+        return self.get_attribute(key, default)
+    def set_attributes(self, items):
+        """sets each (ATTR, VALUE) of ITEMS as one mutation.
+
+        Entities whose attributes are still a tuple keep a tuple.
+        """
+        a = self._attributes
+        if type(a) is not tuple:
+            a.update(items)
+            return
+        pairs = list(a)
+        keys = list(a[::2])
+        for attr, value in items:
+            if attr in keys:
+                pairs[2 * keys.index(attr) + 1] = value
+            else:
+                if type(attr) is str:
+                    attr = intern(attr)
+                # later ITEMS may set it again
+                keys.append(attr)
+                pairs.append(attr)
+                pairs.append(value)
+        setslot = object.__setattr__
+        setslot(self, '_attributes', tuple(pairs))
+        if 'tag' in keys:
+            setslot(self, '_tag', pairs[2 * keys.index('tag') + 1])
+        mutated(self)
+    def get_attribute(self, key, default=None):
+        a = self._attributes
+        if type(a) is tuple:
+            for i in xrange(0, len(a), 2):
+                if a[i] == key:
+                    return a[i + 1]
+            return default
+        else:
+            return a.get(key, default)
     def __getattr__(self, attr):
         #print "entity __getattr__ %s" % attr
-        try:
+        if attr in entity.__slots__:
+            # not set yet
+            raise AttributeError, attr
+        elif hasattr(attributes, attr):
             return getattr(self.attributes, attr)
-        except KeyError:
+        value = self.get_attribute(dequote_identifier(attr),
+                                   AttributeNonexistent)
+        if value is AttributeNonexistent:
             return searchable.__getattr__(self, attr)
+        return value
     def __setattr__(self, attr, value):
         #print "entity __setattr__ %s" % attr
         self.attributes[attr] = value
@@ -526,58 +1163,199 @@ class entity(object, UserDict.DictMixin, searchable, renderable):
             # ??? unnecessary?
             del self.contents.attr
     def keys(self):
-        return self.attributes.keys_not_tag()
+        for k, v in self.attribute_items():
+            yield k
     #def items(self): return self.attributes.items()
     def get_tag(self):
-        return self.attributes['tag']
+        if type(self._attributes) is tuple:
+            return self._tag
+        return self._attributes['tag']
     def set_tag(self, value):
         self.attributes['tag'] = value
     tag = property(get_tag, set_tag)
-    def as_html(self):
-        return '<%s>%s</%s>' % (self.attributes.as_html(),
-                                self.contents.as_html(), self.tag)
+    def as_html(self, out=None, escape=False):
+        return render_html(html_fragments([ self ], escape), out)
+    def iter_html(self, escape=False):
+        return html_fragments([ self ], escape)
+    # pieces used by html_fragments() to render without recursion
+    def as_html_start(self):
+        a = self._attributes
+        if type(a) is tuple and len(a) == 2:
+            # just the tag
+            return '<%s>' % a[1]
+        return '<%s>' % ' '.join(html_attribute_args(self.tag,
+                                                     self.attribute_items()))
+    def as_html_children(self):
+        return self.contents
+    def as_html_end(self):
+        return '</%s>' % (self.tag,)
     def as_python(self, module_prefix=None):
         if module_prefix is None:
             module_prefix = self.module_prefix
         return '%s%s(%s)' % (
             module_prefix, quote_identifier(self.tag),
             ','.join(self.contents.as_python_args(module_prefix)
-                     + self.attributes.as_python_args())
+                     + python_attribute_args(self.attribute_items()))
             )
     def as_text(self):
+        if self._cache is not None:
+            return cached_text(self)
         return self.contents.as_text()
+    def iter_text(self):
+        return text_fragments([ self ])
     def as_info(self):
         return '<%s.%s [<%s%s>%s]>' % (
             self.__module__, self.__class__.__name__,
             self.tag,
-            substfmt(self.attributes.as_info(), ' %s'),
+            substfmt(self.attribute_dict().as_info(), ' %s'),
             substfmt(self.contents.as_info(), '%%s</%s>' % self.tag))
     __str__ = renderable.__str__
     __repr__ = renderable.__repr__
     # XXX replace?
 
+# DictMixin's methods, without the instance dict a classic base brings
+for name in ('has_key', 'iteritems', 'iterkeys', 'itervalues', 'values',
+             'items', 'clear', 'setdefault', 'popitem', 'update'):
+    setattr(entity, name, UserDict.DictMixin.__dict__[name])
+
+def new_entity(cls):
+    """an empty CLS, or entity class registered for tag CLS, to unpickle."""
+    if is_string(cls):
+        cls = getattr(entities, quote_identifier(cls))
+    return cls.__new__(cls)
+
+def keywords(**attrs):
+    # the keyword dict attributes(**attrs) used to see, so the
+    # attributes end up in the same order
+    return attrs
+
+def attribute_pairs(items):
+    """flattens the (ATTR, VALUE) ITEMS into (KEY, VALUE, ...) with
+    dequoted, interned keys, the last value of a repeated key winning."""
+    pairs = [ ]
+    # KEY => where its value is in pairs
+    values = { }
+    for attr, value in items:
+        if attr[-1:] == '_' or not attr.islower():
+            attr = dequote_identifier(attr)
+        if type(attr) is str:
+            attr = intern(attr)
+        i = values.get(attr)
+        if i is None:
+            values[attr] = len(pairs) + 1
+            pairs.append(attr)
+            pairs.append(value)
+        else:
+            # class and class_
+            pairs[i] = value
+    if len(pairs) == 2 and 'tag' in values:
+        return tag_pairs(pairs[1])
+    i = values['tag']
+    if type(pairs[i]) is str:
+        pairs[i] = intern(pairs[i])
+    return tuple(pairs)
+
+def tag_pairs(tag):
+    """the ('tag', TAG) attributes shared by entities without others."""
+    try:
+        return shared_tag_pairs[tag]
+    except KeyError:
+        if type(tag) is str:
+            tag = intern(tag)
+        pairs = shared_tag_pairs[tag] = ('tag', tag)
+        return pairs
+    except TypeError:
+        return ('tag', tag)
+
+shared_tag_pairs = { }
+
 class quiet_entity(entity):
-    def as_html(self):
+    __slots__ = ()
+    def as_html_start(self):
+        return ''
+    def as_html_children(self):
+        return ()
+    def as_html_end(self):
         return ''
     def as_text(self):
         return ''
 
 class empty_entity(entity):
-    def as_html(self):
-        return '<%s>' % (self.attributes.as_html(),)
+    __slots__ = ()
+    def as_html_children(self):
+        return ()
+    def as_html_end(self):
+        return ''
 
 class comment(entity):
-    def as_html(self):
-        return '<!--%s-->' % (self.contents.as_html(),)
+    __slots__ = ()
+    def as_html_start(self):
+        return '<!--'
+    def as_html_end(self):
+        return '-->'
 
 class document(entity):
-    def as_html(self):
-        return self.contents.as_html()
+    __slots__ = ()
+    def as_html_start(self):
+        return ''
+    def as_html_end(self):
+        return ''
     def as_text(self):
         return ''
 
 class contents(list, searchable, renderable):
     """simple concatenating recursive container."""
+    # the entity holding these contents, while it caches its renditions
+    __slots__ = ('_owner',)
+    def __getstate__(self):
+        return None
+    def uncache(self):
+        try:
+            owner = contents_owner(self)
+        except AttributeError:
+            # never cached: searchable.__getattr__ need not look
+            return
+        uncache(owner)
+    # every mutation goes through mutated()
+    def append(self, item):
+        mutated(self)
+        list.append(self, item)
+    def insert(self, i, item):
+        mutated(self)
+        list.insert(self, i, item)
+    def extend(self, other):
+        mutated(self)
+        list.extend(self, other)
+    def pop(self, i=-1):
+        mutated(self)
+        return list.pop(self, i)
+    def remove(self, item):
+        mutated(self)
+        list.remove(self, item)
+    def reverse(self):
+        mutated(self)
+        list.reverse(self)
+    def sort(self, *args, **kwargs):
+        mutated(self)
+        list.sort(self, *args, **kwargs)
+    def __setitem__(self, key, value):
+        mutated(self)
+        list.__setitem__(self, key, value)
+    def __delitem__(self, key):
+        mutated(self)
+        list.__delitem__(self, key)
+    def __setslice__(self, i, j, other):
+        mutated(self)
+        list.__setslice__(self, i, j, other)
+    def __delslice__(self, i, j):
+        mutated(self)
+        list.__delslice__(self, i, j)
+    def __iadd__(self, other):
+        mutated(self)
+        return list.__iadd__(self, other)
+    def __imul__(self, n):
+        mutated(self)
+        return list.__imul__(self, n)
     def first(self):
         return self[0]
     def last(self):
@@ -590,13 +1368,10 @@ class contents(list, searchable, renderable):
         return self[m:n]
     def slice3(self, m, n, i):
         return self[m:n:i]
-    def as_html(self):
-        def as_html(c):
-            if is_string(c):
-                return c
-            else:
-                return c.as_html()
-        return ''.join(map(as_html, self))
+    def as_html(self, out=None, escape=False):
+        return render_html(html_fragments(self, escape), out)
+    def iter_html(self, escape=False):
+        return html_fragments(self, escape)
     def as_python(self, module_prefix=None):
         return repr(self.as_python_args(module_prefix))
     def as_python_args(self, module_prefix=None):
@@ -613,6 +1388,8 @@ class contents(list, searchable, renderable):
             else:
                 return c.as_text()
         return ''.join(map(as_text, self))
+    def iter_text(self):
+        return text_fragments(self)
     def as_info(self):
         if len(self) == 0:
             return ''
@@ -629,15 +1406,44 @@ class contents(list, searchable, renderable):
     __str__ = renderable.__str__
     __repr__ = renderable.__repr__
     
+contents_owner = contents.__dict__['_owner'].__get__
+
 class attributes(dict, UserDict.DictMixin, renderable):
     """unordered key-value container."""
     def __init__(self, **attrs):
         for attr, value in attrs.items():
             # class_ => class
             # id_ =-> id
-            self[dequote_identifier(attr)] = value
+            dict.__setitem__(self, dequote_identifier(attr), value)
+    def uncache(self):
+        uncache(self.__dict__.get('_owner'))
+    # every mutation goes through mutated()
+    def __setitem__(self, key, value):
+        mutated(self)
+        dict.__setitem__(self, key, value)
+    def __delitem__(self, key):
+        mutated(self)
+        dict.__delitem__(self, key)
+    def clear(self):
+        mutated(self)
+        dict.clear(self)
+    def pop(self, *args):
+        mutated(self)
+        return dict.pop(self, *args)
+    def popitem(self):
+        mutated(self)
+        return dict.popitem(self)
+    def setdefault(self, key, default=None):
+        mutated(self)
+        return dict.setdefault(self, key, default)
+    def update(self, *args, **kwargs):
+        mutated(self)
+        dict.update(self, *args, **kwargs)
     # object attribute shortcuts
     def __getattr__(self, attr):
+        if attr.startswith('__'):
+            # pickle and copy probing for __setstate__ and the like
+            raise AttributeError, attr
         return self[dequote_identifier(attr)]
     def __setattr__(self, attr, value):
         #print "attributes __setattr__ %s" % attr
@@ -646,27 +1452,26 @@ class attributes(dict, UserDict.DictMixin, renderable):
         del self[dequote_identifier(attr)]
     def __getstate__(self):
         return dict(self)
+    def __setstate__(self, state):
+        # the items themselves are restored as the dict's
+        pass
     def keys_not_tag(self):
         for k in self.keys():
             if k != 'tag':
                 yield k
-    def as_html(self):
-        return ' '.join(self.as_html_args())
+    def as_html(self, out=None):
+        if out is None:
+            return ' '.join(self.as_html_args())
+        else:
+            out.write(' '.join(self.as_html_args()))
     def as_html_args(self):
-        def as_html(k, v):
-            #k = dequote_identifier(k) ???
-            if v is None:
-                return k
-            else:
-                v = sgml_escape_quotes_too(str(v))
-                return '%s="%s"' % (k, v)
-        return ([ self['tag'] ]
-                + [ as_html(k, self[k]) for k in self.keys_not_tag() ])
+        return html_attribute_args(self['tag'],
+                                   [ (k, self[k]) for k in self.keys_not_tag() ])
     def as_python(self):
         return dict.__repr__(self)
     def as_python_args(self):
-        return [ '%s=%r' % (quote_identifier(k), self[k])
-                 for k in self.keys_not_tag() ]
+        return python_attribute_args([ (k, self[k])
+                                       for k in self.keys_not_tag() ])
     def as_text(self):
         return ''
     def as_info(self):
@@ -683,6 +1488,431 @@ class attributes(dict, UserDict.DictMixin, renderable):
     __str__ = renderable.__str__
     __repr__ = renderable.__repr__
 
+def html_fragments(items, escape=False):
+    """yields the HTML rendition of ITEMS piece by piece.
+
+    An explicit stack replaces the recursion through as_html(), so
+    nothing is concatenated per nesting level.  Entity classes that
+    override as_html() themselves are rendered by calling it.
+
+    Strings are taken to be HTML already, as parsed ones are; with
+    ESCAPE they are plain text and get &, < and > escaped, except in
+    comments, scripts and styles.
+    """
+    stack = [ iter(items) ]
+    ends = [ '' ]
+    # whether the strings at each level get escaped
+    escaping = [ escape ]
+    streamable = streamable_classes
+    while stack:
+        for c in stack[-1]:
+            if isinstance(c, basestring) or is_string(c):
+                if escaping[-1] and isinstance(c, basestring):
+                    c = sgml_escape(c)
+                yield c
+                continue
+            t = type(c)
+            if t not in streamable:
+                streamable[t] = (issubclass(t, entity)
+                                 and t.as_html.im_func is entity_as_html)
+            if streamable[t]:
+                if c._cache is not None and not escape:
+                    yield cached_html(c)
+                    continue
+                start = c.as_html_start()
+                if start:
+                    yield start
+                children = c.as_html_children()
+                if children:
+                    stack.append(iter(children))
+                    ends.append(c.as_html_end())
+                    escaping.append(escape and not isinstance(c, comment)
+                                    and c.tag not in raw_text_tags)
+                    break
+                end = c.as_html_end()
+                if end:
+                    yield end
+            else:
+                yield c.as_html()
+        else:
+            stack.pop()
+            escaping.pop()
+            end = ends.pop()
+            if end:
+                yield end
+
+# their text is not HTML and is never escaped
+raw_text_tags = frozenset(('script', 'style'))
+
+def cached_html(e):
+    """the HTML rendition of E, kept by E and the entities within."""
+    html = e._cache[1]
+    if html is not None:
+        return html
+    stack = [ (e, iter(e.as_html_children()), [ e.as_html_start() ]) ]
+    streamable = streamable_classes
+    while stack:
+        e, children, parts = stack[-1]
+        for c in children:
+            if isinstance(c, basestring) or is_string(c):
+                parts.append(c)
+                continue
+            if isinstance(c, entity):
+                cache = link_cache(c, e)
+                t = type(c)
+                if t not in streamable:
+                    streamable[t] = t.as_html.im_func is entity_as_html
+                if streamable[t]:
+                    if cache[1] is not None:
+                        parts.append(cache[1])
+                    else:
+                        stack.append((c, iter(c.as_html_children()),
+                                      [ c.as_html_start() ]))
+                        break
+                    continue
+            parts.append(c.as_html())
+        else:
+            stack.pop()
+            parts.append(e.as_html_end())
+            html = e._cache[1] = ''.join(parts)
+            if stack:
+                stack[-1][2].append(html)
+    return html
+
+def cached_text(e):
+    """the as_text() rendition of E, kept like cached_html()'s."""
+    text = e._cache[2]
+    if text is not None:
+        return text
+    stack = [ (e, iter(e.contents), [ ]) ]
+    while stack:
+        e, children, parts = stack[-1]
+        for c in children:
+            if isinstance(c, basestring) or is_string(c):
+                parts.append(c)
+                continue
+            if isinstance(c, entity):
+                cache = link_cache(c, e)
+                if type(c).as_text.im_func is entity_as_text:
+                    if cache[2] is not None:
+                        parts.append(cache[2])
+                    else:
+                        stack.append((c, iter(c.contents), [ ]))
+                        break
+                    continue
+            parts.append(c.as_text())
+        else:
+            stack.pop()
+            text = e._cache[2] = ''.join(parts)
+            if stack:
+                stack[-1][2].append(text)
+    return text
+
+def link_cache(e, parent):
+    """E's [ PARENTS, HTML, TEXT ] rendition cache, made if need be."""
+    cache = e._cache
+    if cache is None:
+        cache = [ [ parent ], None, None ]
+        object.__setattr__(e, '_cache', cache)
+        object.__setattr__(e.contents, '_owner', e)
+        if type(e._attributes) is not tuple:
+            e._attributes.__dict__['_owner'] = e
+        return cache
+    parents = cache[0]
+    for p in parents:
+        if p is parent:
+            return cache
+    # it may have moved since, or be within several entities at once
+    parents[:] = [ p for p in parents if contains_entity(p, e) ]
+    parents.append(parent)
+    return cache
+
+def contains_entity(parent, e):
+    """whether E itself is one of PARENT's contents."""
+    for c in parent.contents:
+        if c is e:
+            return True
+    return False
+
+class root_cache(list):
+    """the rendition cache of an entity cache_rendering() was called on."""
+    __slots__ = ('__weakref__',)
+
+def cache_root(e):
+    """makes E cache its renditions, registered in render_caches."""
+    cache = e._cache
+    if cache is None:
+        cache = root_cache([ [ ], None, None ])
+        object.__setattr__(e.contents, '_owner', e)
+        if type(e._attributes) is not tuple:
+            e._attributes.__dict__['_owner'] = e
+    else:
+        # rendered within another caching tree already
+        cache = root_cache(cache)
+    object.__setattr__(e, '_cache', cache)
+    key = id(cache)
+    def forget(ref):
+        render_caches.pop(key, None)
+    render_caches[key] = weakref.ref(cache, forget)
+
+def uncache(e):
+    """forgets the renditions of E and every entity it is within."""
+    if e is None or e._cache is None:
+        return
+    work = [ e ]
+    seen = set()
+    while work:
+        e = work.pop()
+        cache = e._cache
+        if cache is None or id(e) in seen:
+            continue
+        seen.add(id(e))
+        cache[1] = cache[2] = None
+        work.extend(cache[0])
+
+# weak references to the root_caches of the trees that
+# cache_rendering(), by id; until there are some no mutation looks
+# for caches to forget.  Trees garbage collected drop out by themselves.
+render_caches = { }
+
+def write_fragments(fragments, out, size=8192):
+    """writes FRAGMENTS to the file-like OUT in chunks of about SIZE.
+
+    => the number of bytes written
+    """
+    buffer = [ ]
+    buffered = 0
+    written = 0
+    for s in fragments:
+        buffer.append(s)
+        buffered += len(s)
+        if buffered >= size:
+            out.write(''.join(buffer))
+            written += buffered
+            buffer = [ ]
+            buffered = 0
+    if buffer:
+        out.write(''.join(buffer))
+    return written + buffered
+
+def render_html(fragments, out=None):
+    """FRAGMENTS joined, or written to OUT, counted in stats."""
+    if not stats.enabled:
+        if out is None:
+            return ''.join(fragments)
+        write_fragments(fragments, out)
+        return
+    start = time.time()
+    if out is None:
+        result = ''.join(fragments)
+        written = len(result)
+    else:
+        result = None
+        written = write_fragments(fragments, out)
+    stats.count('render calls')
+    stats.count('render bytes', written)
+    stats.add_time('render', time.time() - start)
+    return result
+
+entity_as_html = entity.as_html.im_func
+streamable_classes = { }
+
+def text_fragments(items):
+    """yields the as_text() rendition of ITEMS piece by piece."""
+    stack = [ iter(items) ]
+    while stack:
+        for c in stack[-1]:
+            if isinstance(c, basestring) or is_string(c):
+                yield c
+            elif (isinstance(c, entity)
+                  and type(c).as_text.im_func is entity_as_text):
+                if c._cache is not None and c._cache[2] is not None:
+                    yield c._cache[2]
+                    continue
+                stack.append(iter(c.contents))
+                break
+            else:
+                yield c.as_text()
+        else:
+            stack.pop()
+
+def text_contains(fragments, s):
+    """'S' in ''.join(FRAGMENTS), reading only as far as the first match."""
+    if not s:
+        return True
+    overlap = len(s) - 1
+    tail = ''
+    for fragment in fragments:
+        text = tail + fragment
+        if s in text:
+            return True
+        # keep enough to catch a match spanning into the next fragment
+        if overlap:
+            tail = text[-overlap:]
+    return False
+
+entity_as_text = entity.as_text.im_func
+
+def mutated(changed):
+    """forgets the cached renditions and the tree_index()es that
+    CHANGED, an entity or its contents or attributes, is part of."""
+    if render_caches:
+        if isinstance(changed, entity):
+            uncache(changed)
+        else:
+            changed.uncache()
+    if tree_indexes:
+        key = id(changed)
+        for ref in tree_indexes.values():
+            index = ref()
+            if index is not None and key in index.members:
+                index.forget()
+
+class tree_index(object):
+    """tag, id and class lookup tables for an entity tree.
+
+    tree_index.tables['tag']['TAG']       => [ CURSOR... ]
+    tree_index.tables['id']['ID']         => [ CURSOR... ]
+    tree_index.tables['class']['CLASS']   => [ CURSOR... ]
+    tree_index.findall(LAMBDA, NEST, MIN_DEPTH, MAX_DEPTH, DEPTH_FIRST)
+                                          => [ CURSOR... ] or None
+
+    The cursors are in document order.  Changing the contents or
+    attributes of any entity in the tree makes the index stale.
+    """
+    keys = ('tag', 'id', 'class')
+    def __init__(self, root):
+        # ids of the entities, contents and attributes in the tree
+        self.members = members = set()
+        self.tables = { }
+        for k in self.keys:
+            self.tables[k] = { }
+        tables = [ (k, self.tables[k]) for k in self.keys ]
+        work = [ cursor(root, None, None, 0) ]
+        while work:
+            c = work.pop()
+            e = c.delegate
+            members.add(id(e))
+            members.add(id(e.contents))
+            if type(e._attributes) is not tuple:
+                members.add(id(e._attributes))
+            for k, table in tables:
+                value = e.get(k, AttributeNonexistent)
+                if value is not AttributeNonexistent:
+                    try:
+                        table.setdefault(value, [ ]).append(c)
+                    except TypeError:
+                        # unhashable values never equal a hashable one
+                        pass
+            depth = c.depth + 1
+            children = [ cursor(x, c, i, depth)
+                         for i, x in enumerate(e.contents)
+                         if isinstance(x, entity) ]
+            children.reverse()
+            work.extend(children)
+        key = id(self)
+        def forget(ref):
+            tree_indexes.pop(key, None)
+        tree_indexes[key] = weakref.ref(self, forget)
+    def stale(self):
+        return self.members is None
+    def forget(self):
+        self.members = None
+        tree_indexes.pop(id(self), None)
+    def candidates(self, fn):
+        """cursors possibly matching FN, or None if FN is not indexable."""
+        form = criterion_form(fn)
+        if form[0] == 'and':
+            terms = [ criterion_form(c) for c in form[1:] ]
+        else:
+            terms = [ form ]
+        for term in terms:
+            while term[0] == 'outside':
+                term = criterion_form(term[1])
+            if (term[0] == 'attribute' and term[1] in self.tables
+                and term[2] is not AttributeExists):
+                try:
+                    return self.tables[term[1]].get(term[2], [ ])
+                except TypeError:
+                    pass
+        return None
+    def findall(self, fn, nest, min_depth, max_depth, depth_first,
+                skip=None, prune=None):
+        """searchable.findall() results for FN, or None if not indexable.
+
+        Entities tagged one of SKIP, or for which PRUNE(CURSOR), are not
+        searched within.
+        """
+        found = self.candidates(fn)
+        if found is None:
+            return None
+        if skip or prune:
+            def pruned(c):
+                a = c.parent
+                while a is not None:
+                    if (skip and a.tag in skip) or (prune and prune(a)):
+                        return True
+                    a = a.parent
+                return False
+            found = [ c for c in found if not pruned(c) ]
+        found = [ c for c in found if c.depth >= min_depth and fn(c) ]
+        if not nest:
+            # the walk would not have descended into matches
+            hit = set([ id(c) for c in found ])
+            def nested(c):
+                a = c.parent
+                while a is not None and a.depth >= min_depth:
+                    if id(a) in hit:
+                        return True
+                    a = a.parent
+                return False
+            found = [ c for c in found if not nested(c) ]
+        found = [ c for c in found if c.depth <= max_depth ]
+        if not depth_first:
+            # level by level, document order within a level
+            found.sort(key=lambda c: c.depth)
+        return found
+
+def indexed_attributes(e, a):
+    """adds A, the attributes E has just been given, to the members of
+    the tree_index()es E is in."""
+    key = id(e)
+    for ref in tree_indexes.values():
+        index = ref()
+        if index is not None and key in index.members:
+            index.members.add(id(a))
+
+# weak references to the tree_index()es that are not stale, by id; until
+# there are some no mutation looks for them.
+tree_indexes = { }
+
+def html_attribute_args(tag, items):
+    """[ TAG, 'KEY="VALUE"'... ] for the (KEY, VALUE) ITEMS."""
+    args = [ tag ]
+    known = attribute_html
+    for item in items:
+        k, v = item
+        if type(v) is str:
+            # the same class="..." and the like come up again and again
+            arg = known.get(item)
+            if arg is None:
+                if len(known) >= 4096:
+                    known.clear()
+                arg = known[item] = '%s="%s"' % (k, sgml_escape_quotes_too(v))
+        elif v is None:
+            #k = dequote_identifier(k) ???
+            arg = k
+        else:
+            arg = '%s="%s"' % (k, sgml_escape_quotes_too(str(v)))
+        args.append(arg)
+    return args
+
+# (KEY, VALUE) => 'KEY="VALUE"' for string values, see html_attribute_args
+attribute_html = { }
+
+def python_attribute_args(items):
+    return [ '%s=%r' % (quote_identifier(k), v) for k, v in items ]
+
 class view(object):
     """
     (unvetted)
@@ -693,56 +1923,257 @@ class view(object):
     def __init__(self):
         raise "NYI"
 
-class matches(tuple, searchable):
+class matches(searchable):
     """lazy immutable list of search results.
-    
+
+    Results are pulled from the search only as far as they are asked
+    for, and kept.
+
     list(MATCHES)           => [ CURSOR... ]
-    MATCHES.parents
+    len(MATCHES)
+    MATCHES[N]              => CURSOR
+    MATCHES[M:N]            => MATCHES
+    CURSOR in MATCHES       => whether it is at one of the matches
+    ENTITY in MATCHES
+    'SUBSTRING' in MATCHES  => whether any match's text has it
+    CLASS in MATCHES
+    MATCHES.parents         => MATCHES, each parent once
+    MATCHES.findall(LAMBDA) => MATCHES within any of the MATCHES
+
+    bulk changes, each entity or parent changed once:
+    MATCHES.set(ATTR=VALUE...)          => MATCHES
+    MATCHES.update_attrs(LAMBDA)        => MATCHES
+    MATCHES.wrap(TAG, ATTR=VALUE...)    => MATCHES of the wrappers
+    MATCHES.remove()                    => how many were removed
     """
+    __slots__ = ('matches', 'match_maker')
     def __init__(self, matches):
-        raise "NYI"
-        if is_generator(matches):
-            self.matches = [ ]
-            self.match_maker = matches
-        else:
-            self.matches = matches
+        if is_sequence(matches):
+            self.matches = list(matches)
             self.match_maker = None
+        else:
+            self.matches = [ ]
+            self.match_maker = iter(matches)
+    def fill(self, n=None):
+        """pulls results until there are N, or all of them."""
+        found = self.matches
+        maker = self.match_maker
+        if maker is None:
+            return
+        try:
+            if n is None:
+                found.extend(maker)
+            else:
+                while len(found) < n:
+                    found.append(maker.next())
+                return
+        except StopIteration:
+            pass
+        self.match_maker = None
     def __len__(self):
-        raise "NYI"
+        self.fill()
+        return len(self.matches)
+    def __nonzero__(self):
+        self.fill(1)
+        return len(self.matches) > 0
     def __getitem__(self, key):
-        if self.match_maker is not None:
-            if key >= 0:
-                try:
-                    remainder = key - len(self.matches)
-                    while remainder > 0:
-                        c = self.match_maker.next()
-                        self.matches.append(c)
-                        remainder -= 1
-                except StopIteration:
-                    self.match_maker = None
-                    raise IndexError
+        if isinstance(key, slice):
+            if (key.stop is None or key.stop < 0
+                or (key.start is not None and key.start < 0)):
+                self.fill()
             else:
-                try:
-                    while True:
-                        self.matches.append(self.match_maker.next())
-                except StopIteration:
-                    self.match_maker = None
-        return self.matches[key]
+                self.fill(key.stop)
+            return matches(self.matches[key])
+        elif isinstance(key, int):
+            if key < 0:
+                self.fill()
+            else:
+                self.fill(key + 1)
+            return self.matches[key]
+        else:
+            raise TypeError, key
     def __iter__(self):
-        for c in self.matches:
-            yield c
-        if self.match_maker is not Null:
-            try:
-                while True:
-                    c = self.match_maker.next()
-                    self.matches.append(c)
-                    yield c
-            except StopIteration:
-                self.match_maker = None
+        # by position, so other iterations may pull results meanwhile
+        found = self.matches
+        i = 0
+        while True:
+            if i < len(found):
+                yield found[i]
+                i += 1
+            elif self.match_maker is None:
+                return
+            else:
+                self.fill(i + 1)
+    def __contains__(self, item):
+        if isinstance(item, cursor):
+            key = position_key(item)
+            for c in self:
+                if c is item or position_key(c) == key:
+                    return True
+        elif isinstance(item, type):
+            for c in self:
+                if type(c.delegate) == item:
+                    return True
+        elif is_string(item):
+            for c in self:
+                if is_string(c.delegate):
+                    if item in c.delegate:
+                        return True
+                elif text_contains(c.iter_text(), item):
+                    return True
+        elif isinstance(item, frozen_entity):
+            for c in self:
+                e = c.delegate
+                if (isinstance(e, frozen_entity)
+                    and e.document is item.document and e.node == item.node):
+                    return True
+        else:
+            for c in self:
+                if c.delegate is item:
+                    return True
+        return False
     def get_parents(self):
-        for c in self:
-            yield c.parent
+        return matches(self.iter_parents())
     parents = property(get_parents)
+    def set(self, **attrs):
+        """sets ATTRS on every matched entity."""
+        items = [ (dequote_identifier(k), v) for k, v in attrs.items() ]
+        for c in self.matched_entities():
+            c.delegate.set_attributes(items)
+        return self
+    def update_attrs(self, fn):
+        """sets the { ATTR: VALUE } FN(CURSOR) returns on every entity."""
+        for c in self.matched_entities():
+            changes = fn(c)
+            if changes:
+                c.delegate.set_attributes([ (dequote_identifier(k), v)
+                                            for k, v in changes.items() ])
+        return self
+    def wrap(self, tag, **attrs):
+        """puts each match in a new TAG entity where it was."""
+        if is_string(tag):
+            tag_class = getattr(entities, quote_identifier(tag), None)
+            if tag_class is None:
+                attrs['tag'] = tag
+                tag_class = entity
+        else:
+            tag_class = tag
+        wrappers = [ ]
+        for parent, children in self.by_parent():
+            items = list(parent.delegate.contents)
+            for i, c in children:
+                items[i] = tag_class(items[i], **attrs)
+                wrappers.append(cursor(items[i], parent, i))
+            parent.delegate.contents[:] = items
+        return matches(wrappers)
+    def remove(self):
+        """takes every match out of its parent's contents."""
+        removed = 0
+        for parent, children in self.by_parent():
+            items = parent.delegate.contents
+            if len(children) == 1:
+                del items[children[0][0]]
+            else:
+                drop = set([ i for i, c in children ])
+                items[:] = [ item for i, item in enumerate(items)
+                             if i not in drop ]
+            removed += len(children)
+        return removed
+    def matched_entities(self):
+        # every match first: changes must not disturb a pending search
+        self.fill()
+        for c in self.matches:
+            if isinstance(c.delegate, frozen_entity):
+                c.delegate.read_only()
+        return [ c for c in self.matches if isinstance(c.delegate, entity) ]
+    def by_parent(self):
+        """[ (PARENT, [ (INDEX, CURSOR)... ])... ], each child once.
+
+        The index is where the child is now, whatever changed since the
+        cursor's which_child was taken.
+        """
+        self.fill()
+        groups = { }
+        order = [ ]
+        for c in self.matches:
+            parent = c.parent
+            if parent is None:
+                raise ValueError, 'the root has no parent to change'
+            if isinstance(parent.delegate, frozen_entity):
+                parent.delegate.read_only()
+            group = groups.get(id(parent.delegate))
+            if group is None:
+                group = groups[id(parent.delegate)] = (parent, { })
+                order.append(group)
+            items = parent.delegate.contents
+            i = c.which_child
+            if i >= len(items) or items[i] is not c.delegate:
+                for i in xrange(len(items)):
+                    if items[i] is c.delegate:
+                        break
+                else:
+                    # no longer there
+                    continue
+            group[1][i] = c
+        return [ (parent, sorted(children.items()))
+                 for parent, children in order ]
+    def iter_parents(self):
+        seen = set()
+        for c in self:
+            parent = c.parent
+            if parent is not None:
+                key = position_key(parent)
+                if key not in seen:
+                    seen.add(key)
+                    yield parent
+    def iter_findall(self, fn, nest=1, min_depth=1, max_depth=sys.maxint,
+                     depth_first=True, prune=None):
+        # searches under each match, depths counted from that match.
+        # Unbounded nesting searches cover the matches within a match
+        # already searched, so those are skipped; otherwise each match
+        # is searched and what several of them find is yielded once.
+        within = nest and max_depth == sys.maxint and prune is None
+        searched = set()
+        for c in self:
+            if within:
+                p = c
+                while p is not None and position_key(p) not in searched:
+                    p = p.parent
+                if p is not None:
+                    continue
+                searched.add(position_key(c))
+            depth = c.depth
+            for found in c.iter_findall(fn, nest, depth + min_depth,
+                                        depth + max_depth, depth_first,
+                                        prune):
+                if not within:
+                    key = position_key(found)
+                    if key in searched:
+                        continue
+                    searched.add(key)
+                yield found
+    def __repr__(self):
+        if self.match_maker is None:
+            more = ''
+        else:
+            more = '...'
+        return '<%s.%s %r%s>' % (self.__module__, self.__class__.__name__,
+                                 self.matches, more)
+
+def position_key(c):
+    """identifies where cursor C is in its tree, for as long as it lives."""
+    if c.parent is None:
+        e = c.delegate
+        which = None
+    else:
+        e = c.parent.delegate
+        which = c.which_child
+    if isinstance(e, frozen_entity):
+        # views of the same node are different objects
+        return (id(e.document), e.node, which)
+    elif which is None:
+        return id(e)
+    return (id(e), which)
     """tupleitize a list:
     def __setitem__(self, key, value): raise
     def __delitem__(self, key): raise
@@ -762,12 +2193,13 @@ class path(list, searchable):
     list(path)              => [ cursor(...)... ]
     #path.parents
     """
+    __slots__ = ()
     #def get_parents(self):
     #    for c in self:
     #        yield c.parent
     #parents = property(get_parents)
 
-class cursor(object, searchable, renderable):
+class cursor(searchable, renderable):
     """entity proxy with positional information.
 
     cursor.ATTR            => CURSOR.delegate.ATTR
@@ -775,13 +2207,20 @@ class cursor(object, searchable, renderable):
     cursor.previous
     cursor.sibbling(OFFSET)
     cursor.parent
+    cursor.depth           => len(CURSOR.ancestors)
+    cursor.ancestors       => path(ROOT, ..., CURSOR.parent)
+    cursor.path            => path(ROOT, ..., CURSOR)
     """
-    def __init__(self, delegate, ancestors, which_child):
-        self.delegate = delegate
-        self.ancestors = ancestors
-        self.which_child = which_child
+    __slots__ = ('delegate', 'parent', 'which_child', '_depth')
+    def __init__(self, delegate, parent, which_child, depth=None):
+        # parent is another cursor (or None at the root); depth and path
+        # are derived from the parent chain only when asked for.
+        object.__setattr__(self, 'delegate', delegate)
+        object.__setattr__(self, 'parent', parent)
+        object.__setattr__(self, 'which_child', which_child)
+        object.__setattr__(self, '_depth', depth)
     def __getitem__(self, key):
-        return cursor(self.delegate[key], self.ancestors + [ self ], key)
+        return cursor(self.delegate[key], self, key)
     def __delitem__(self, key):
         """WARNING: the offsets stored in other cursors may be affected by deletion."""
         self.delegate[key] = ''
@@ -803,18 +2242,35 @@ class cursor(object, searchable, renderable):
     def get_previous(self):
         return self.sibbling(-1)
     previous = property(get_previous)
-    def get_parent(self):
-        try:
-            return self.ancestors[-1]
-        except IndexError:
-            return None
-    parent = property(get_parent)
+    def get_depth(self):
+        if self._depth is None:
+            if self.parent is None:
+                depth = 0
+            else:
+                depth = self.parent.depth + 1
+            object.__setattr__(self, '_depth', depth)
+        return self._depth
+    depth = property(get_depth)
+    def get_ancestors(self):
+        ancestors = path()
+        c = self.parent
+        while c is not None:
+            ancestors.append(c)
+            c = c.parent
+        ancestors.reverse()
+        return ancestors
+    ancestors = property(get_ancestors)
+    def get_path(self):
+        p = self.ancestors
+        p.append(self)
+        return p
+    path = property(get_path)
     def __getattr__(self, attr):
         # ??? unsure if all __getitem__ covers everything
         #print "cursor __getattr__ %s" % attr
         return getattr(self.delegate, attr)
-    #XXXdef __setattr__(self, attr, value):
-    #    return setattr(self.delegate, attr, value)
+    def __setattr__(self, attr, value):
+        setattr(self.delegate, attr, value)
     def __str__(self):
         if is_string(self.delegate):
             return self.delegate
@@ -865,6 +2321,13 @@ quiet_tags = ('applet', 'embed', 'object')
 empty_tags = ('br', 'area', 'link', 'img', 'param', 'hr',
              'input', 'col', 'base', 'meta', '!doctype',
              'ssi')
+# an open tag of the same name ends these
+implied_end_tags = frozenset(('p', 'tr', 'th', 'td', 'option'))
+empty_tag_set = frozenset(empty_tags)
+# findall(prune=...) sets: what the parser leaves as text, and that with
+# the head, comments and the quiet tags, none of which render as content
+skip_raw_text = raw_text_tags
+skip_non_content = skip_raw_text | frozenset(('head', 'comment') + quiet_tags)
 
 class entities:
     pass
@@ -873,12 +2336,24 @@ def register_entity(tag, tag_class):
     quoted_tag = quote_identifier(tag)
     globals()[quoted_tag] = tag_class
     setattr(entities, quoted_tag, tag_class)
+    starttags[quoted_tag] = starttag_entry(tag_class)
+    # names may now resolve to this tag
+    criterion_names.clear()
+    searchable_names.clear()
 def add_entity(tag):
-    register_entity(tag, type(tag, (entity,), { }))
+    register_entity(tag, type(tag, (entity,), { '__slots__': () }))
 def add_quiet_entity(tag):
-    register_entity(tag, type(tag, (quiet_entity,), { }))
+    register_entity(tag, type(tag, (quiet_entity,), { '__slots__': () }))
 def add_empty_entity(tag):
-    register_entity(tag, type(tag, (empty_entity,), { }))
+    register_entity(tag, type(tag, (empty_entity,), { '__slots__': () }))
+
+def starttag_entry(tag_class):
+    # (CLASS, TAG, EMPTY, IMPLIED_END) for parser.handle_starttag()
+    tag = intern(dequote_identifier(tag_class.__name__))
+    return (tag_class, tag, tag in empty_tag_set, tag in implied_end_tags)
+
+# parsed tag name => starttag_entry() of the class entities has for it
+starttags = { }
 
 for t in tags:
     add_entity(t)
@@ -889,19 +2364,23 @@ for t in empty_tags:
 
 entities.comment = comment
 entities.document = document
+starttags['comment'] = starttag_entry(comment)
+starttags['document'] = starttag_entry(document)
 
 
 __all__ = ([ 'is_string', 'is_index_or_slice', 'is_sequence', 'is_entity',
              'is_tag',
              'first', 'iterskip', 'nth', 'slice1', 'slice2', 'slice3', 'last',
-             'AttributeExists',
+             'AttributeExists', 'stats', 'skip_raw_text', 'skip_non_content',
              'criterion', 'by', 'entity', 'contents', 'attributes', 'view',
-             'matches', 'path', 'cursor',
+             'matches', 'path', 'cursor', 'frozen_document', 'frozen_entity',
              'document' ]
            + map(quote_identifier, tags)
            + map(quote_identifier, quiet_tags)
            + map(quote_identifier, empty_tags)
-           + [ 'parser', 'urlopen', 'parse', 'read', 'openfile' ])
+           + [ 'parser', 'urlopen', 'parse', 'read', 'iterparse',
+               'openfile', 'parse_many', 'fetch_and_parse', 'dumps',
+               'loads', 'freeze' ])
 
 # parsing
 
@@ -909,9 +2388,23 @@ import HTMLParser
 # XXX http://mail.python.org/pipermail/python-list/2002-August/119930.html
 #HTMLParser.interesting_cdata = HTMLParser.interesting_normal
 class parser(HTMLParser.HTMLParser):
+    """HTML to entity tree.
+
+    parser.parse(DATA)            => DOCUMENT
+    parser.urlopen(URL)           => DOCUMENT
+    parser.read(FILE)             => DOCUMENT
+    parser.iterparse(FILE, EVENTS, DISCARD)
+                                  => iter([ (EVENT, ENTITY)... ])
+    """
     def __init__(self):
         self.urlopen_user_agent = None
+        # index parse()d and urlopen()ed documents, see tree_index
+        self.build_index = False
+        # freeze() parse()d and urlopen()ed documents, see frozen_document
+        self.frozen = False
         self.result = None
+        # (EVENT, ENTITY, PARENT) queue, only kept while iterparse()ing
+        self.events = None
     def first_entity(self):
         for t in self.result:
             if is_entity(t):
@@ -921,54 +2414,172 @@ class parser(HTMLParser.HTMLParser):
         self.reset()
         self.feed(data)
         self.close()
-        return self.result
+        return self.finished()
     def urlopen(self, url):
-        self.reset()
         import urllib
         if self.urlopen_user_agent is not None:
             urllib.URLopener.version = self.urlopen_user_agent
-        f = urllib.urlopen(url)
-        data = f.read(8192)
+        return self.read(urllib.urlopen(url))
+    def read(self, file, size=8192):
+        """parses FILE a SIZE chunk at a time, as the chunks arrive."""
+        self.reset()
+        data = file.read(size)
         while data != '':
             self.feed(data)
-            data = f.read(8192)
+            data = file.read(size)
         self.close()
+        return self.finished()
+    def finished(self):
+        if self.build_index:
+            self.result.tree_index()
+        if self.frozen:
+            return freeze(self.result)
         return self.result
+    def iterparse(self, file, events=('end',), discard=(), size=8192):
+        """yields (EVENT, ENTITY) while reading FILE.
+
+        'start' events come with an entity whose contents are still
+        being parsed, 'end' events with a completed entity.  Entities
+        whose tag is in DISCARD are removed from their parent once
+        their 'end' event has been handled, with the whitespace-only
+        text before them (e.g. between rows), so only the unfinished part
+        of the tree stays in memory.  Other text stays where it was.  Emptying a finished entity with
+        del ENTITY[:] works too.
+        """
+        self.reset()
+        self.events = [ ]
+        try:
+            data = file.read(size)
+            while True:
+                if data != '':
+                    self.feed(data)
+                else:
+                    self.close()
+                    self.end_all()
+                pending = self.events
+                self.events = [ ]
+                for event, t, parent in pending:
+                    if event in events:
+                        yield event, t
+                    if (event == 'end' and parent is not None
+                        and t.tag in discard):
+                        # finished entities usually are the last child
+                        c = parent.contents
+                        for i in xrange(len(c) - 1, -1, -1):
+                            if c[i] is t:
+                                j = i
+                                while (j > 0 and is_string(c[j - 1])
+                                       and not c[j - 1].strip()):
+                                    j -= 1
+                                del c[j:i + 1]
+                                break
+                if data == '':
+                    break
+                data = file.read(size)
+        finally:
+            self.events = None
+    def feed(self, data):
+        if not stats.enabled:
+            return HTMLParser.HTMLParser.feed(self, data)
+        start = time.time()
+        HTMLParser.HTMLParser.feed(self, data)
+        stats.count('parser bytes', len(data))
+        stats.add_time('parse', time.time() - start)
+    def close(self):
+        if not stats.enabled:
+            return HTMLParser.HTMLParser.close(self)
+        start = time.time()
+        HTMLParser.HTMLParser.close(self)
+        stats.add_time('parse', time.time() - start)
+    def end_all(self):
+        """ends every entity still open, innermost first."""
+        self.open_tags.clear()
+        while self.stack:
+            t = self.stack.pop()
+            if self.events is not None:
+                if self.stack:
+                    self.events.append(('end', t, self.stack[-1]))
+                else:
+                    self.events.append(('end', t, None))
     def reset(self):
         HTMLParser.HTMLParser.reset(self)
         self.result = document()
         self.stack = [ self.result ]
+        # TAG => how many TAG entities self.stack holds
+        self.open_tags = { self.result.tag: 1 }
     def handle_starttag(self, tag_name, attrs):
-        d = dict(attrs)
-        if (tag_name in ('p', 'tr', 'th', 'td', 'option')
-            and tag_name == self.stack[-1].tag):
-            # implied </tag_name>
-            self.stack.pop()
+        if stats.enabled:
+            stats.count('parser start tags')
+        stack = self.stack
         try:
-            t = getattr(entities, tag_name)(**d)
-        except AttributeError:
+            tag_class, tag, empty, implied_end = starttags[tag_name]
+        except KeyError:
             #raise "parser key error for %s" % tag_name
-            t = entity(tag=tag_name, **d)
-        self.stack[-1].contents.append(t)
-        if t.tag not in empty_tags:
-            self.stack.append(t)
+            tag_class, tag, empty, implied_end = (
+                entity, tag_name, tag_name in empty_tag_set, False)
+        if implied_end and tag_name == stack[-1].tag:
+            # implied </tag_name>
+            t = stack.pop()
+            self.open_tags[tag_name] -= 1
+            if self.events is not None:
+                self.events.append(('end', t, stack[-1]))
+        if not attrs:
+            pairs = tag_pairs(tag)
+        else:
+            # the tag first, then the attributes in source order; a
+            # repeated one, tag= included, keeps its last value
+            pairs = attribute_pairs([ ('tag', tag) ] + attrs)
+            if pairs[1] != tag:
+                tag = pairs[1]
+                empty = tag in empty_tag_set
+        # entity.__init__, without the keywords
+        t = tag_class.__new__(tag_class)
+        setslot = object.__setattr__
+        setslot(t, 'contents', contents())
+        setslot(t, '_attributes', pairs)
+        setslot(t, '_tag', tag)
+        setslot(t, '_index', None)
+        setslot(t, '_cache', None)
+        stack[-1].contents.append(t)
+        if self.events is not None:
+            self.events.append(('start', t, stack[-1]))
+        if not empty:
+            stack.append(t)
+            open_tags = self.open_tags
+            open_tags[tag] = open_tags.get(tag, 0) + 1
+        elif self.events is not None:
+            self.events.append(('end', t, stack[-1]))
     def handle_data(self, data):
+        if stats.enabled:
+            stats.count('parser data')
         self.stack[-1].contents.append(data)
     def handle_charref(self, data):
         self.handle_data('&#%s;' % data)
     def handle_entityref(self, name):
         self.handle_data('&%s;' % name)
     def handle_endtag(self, tag_name):
-        if tag_name in empty_tags:
+        if stats.enabled:
+            stats.count('parser end tags')
+        if tag_name in empty_tag_set:
             return
-        # HACK: try to find possibly mismatched closing tag
-        original_stack = self.stack[:]
-        while len(self.stack) > 0:
-            t = self.stack.pop()
-            if t.tag == tag_name: break
-        else:
-            self.stack = original_stack
+        # mismatched closing tags end every entity opened since the
+        # matching one, and are ignored when nothing matches
+        open_tags = self.open_tags
+        if not open_tags.get(tag_name):
+            return
+        stack = self.stack
+        events = self.events
+        while True:
+            t = stack.pop()
+            open_tags[t.tag] -= 1
+            if events is not None and stack:
+                # innermost first, each with the entity it was appended to
+                events.append(('end', t, stack[-1]))
+            if t.tag == tag_name:
+                break
     def handle_comment(self, data):
+        if stats.enabled:
+            stats.count('parser comments')
         self.stack[-1].contents.append(comment(data))
     def parse_endtag(self, i):
         #http://marc.free.net.ph/message/20041022.235258.ada7712d.html
@@ -986,7 +2597,7 @@ class parser(HTMLParser.HTMLParser):
             self.error('bad end tag: %r' % rawdata[i:j])
         tag = match.group(1)
         #START BUGFIX
-        if self.interesting == HTMLParser.interesting_cdata:
+        if self.in_cdata():
             #we're in of of the CDATA_CONTENT_ELEMENTS
             if (tag.lower() == self.lasttag
                 and tag.lower() in self.CDATA_CONTENT_ELEMENTS):
@@ -1000,6 +2611,12 @@ class parser(HTMLParser.HTMLParser):
             #we're not in a CDATA_CONTENT_ELEMENTS tag. standard ending:
             self.handle_endtag(tag.lower())
         return j
+    def in_cdata(self):
+        """whether inside one of the CDATA_CONTENT_ELEMENTS (script, style)."""
+        # Python 2.7.3 replaced HTMLParser.interesting_cdata with cdata_elem
+        if hasattr(self, 'cdata_elem'):
+            return self.cdata_elem is not None
+        return self.interesting == HTMLParser.interesting_cdata
 
 def urlopen(url):
     doc = parser().urlopen(url)
@@ -1012,17 +2629,1139 @@ def parse(data):
 def read(file):
     return parse(file.read())
 
-def openfile(path):
-    doc = read(open(path))
+def iterparse(file, events=('end',), discard=()):
+    return parser().iterparse(file, events, discard)
+
+def openfile(path, mmap=False):
+    """parses the file at PATH.
+
+    With MMAP the file is memory mapped and parsed a chunk at a time,
+    so big files are never copied whole into a string.
+    """
+    f = open(path)
+    try:
+        if mmap and os.fstat(f.fileno()).st_size > 0:
+            from mmap import mmap as memory_map, ACCESS_READ
+            m = memory_map(f.fileno(), 0, access=ACCESS_READ)
+            try:
+                doc = parser().read(m, 65536)
+            finally:
+                m.close()
+        else:
+            doc = read(f)
+    finally:
+        f.close()
     doc.path = path
     return doc
 
+def parse_many(sources, workers=None, ordered=True, load=parse):
+    """parses SOURCES in a pool of WORKERS processes.
+
+    parse_many(SOURCES)            => iter([ (SOURCE, DOCUMENT, None)... ])
+    parse_many(URLS, load=urlopen) => iter([ (URL, DOCUMENT, None)... ])
+
+    LOAD (parse, read, openfile, urlopen or any module level function)
+    turns each source into a document in a worker; documents come back
+    pickled, attributes and all, in SOURCES order or, unless ORDERED,
+    as they complete.  A source that fails comes back as (SOURCE, None,
+    ERROR) and the rest of the batch carries on.  WORKERS defaults to
+    the number of CPUs; workers=0 parses in this process.
+    """
+    sources = list(sources)
+    tasks = [ (i, load, source) for i, source in enumerate(sources) ]
+    if workers == 0:
+        results = map(parse_task, tasks)
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(workers)
+        if ordered:
+            results = pool.imap(parse_task, tasks)
+        else:
+            results = pool.imap_unordered(parse_task, tasks)
+    try:
+        for i, doc, error in results:
+            yield sources[i], doc, error
+    finally:
+        if workers != 0:
+            pool.terminate()
+            pool.join()
+
+def parse_task(task):
+    # runs in a parse_many() worker
+    i, load, source = task
+    try:
+        return i, load(source), None
+    except Exception, error:
+        import pickle
+        try:
+            pickle.dumps(error)
+        except Exception:
+            error = Exception('%s: %s' % (error.__class__.__name__, error))
+        return i, None, error
+
+def fetch_and_parse(urls, workers=8, per_host=2, user_agent=None,
+                    timeout=None):
+    """fetches and parses URLS, WORKERS at a time.
+
+    fetch_and_parse(URLS) => iter([ (URL, DOCUMENT, None)... ])
+
+    Each response is fed to its parser chunk by chunk as it arrives.
+    At most PER_HOST requests go to one host at once, over HTTP/1.1
+    connections kept alive for that host's next URL.  Documents come
+    as they complete; a URL that fails comes as (URL, None, ERROR)
+    and the rest carry on.  Once the caller stops iterating, no more
+    URLs are fetched.
+    """
+    import Queue
+    urls = list(urls)
+    pending = Queue.Queue()
+    done = Queue.Queue()
+    for url in urls:
+        pending.put(url)
+    pool = connection_pool(per_host, user_agent, timeout)
+    stopped = threading.Event()
+    def work():
+        while not stopped.isSet():
+            try:
+                url = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                done.put((url, pool.fetch(url), None))
+            except Exception, error:
+                done.put((url, None, error))
+    for i in xrange(min(workers, len(urls))):
+        t = threading.Thread(target=work)
+        t.setDaemon(True)
+        t.start()
+    try:
+        for url in urls:
+            yield done.get()
+    finally:
+        stopped.set()
+        pool.close()
+
+class connection_pool(object):
+    """keep-alive HTTP connections, at most PER_HOST busy per host.
+
+    connection_pool().fetch(URL)  => DOCUMENT
+    """
+    redirects = (301, 302, 303, 307)
+    def __init__(self, per_host=2, user_agent=None, timeout=None):
+        if user_agent is None:
+            import urllib
+            user_agent = urllib.URLopener.version
+        self.per_host = per_host
+        self.user_agent = user_agent
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        # (SCHEME, HOST) => [ CONNECTION... ] and => Semaphore
+        self.idle = { }
+        self.slots = { }
+        # after close(), connections are closed instead of kept idle
+        self.closed = False
+    def fetch(self, url, max_redirects=5):
+        import urlparse
+        for i in xrange(max_redirects + 1):
+            scheme, host, path, query, fragment = urlparse.urlsplit(url)
+            if scheme not in ('http', 'https'):
+                raise IOError, ('url error', 'unknown url type', scheme)
+            if query:
+                path = '%s?%s' % (path, query)
+            doc, location = self.get((scheme, host), path or '/')
+            if location is None:
+                doc.url = url
+                return doc
+            url = urlparse.urljoin(url, location)
+        raise IOError, ('http error', 'too many redirects', url)
+    def get(self, key, path):
+        # => (DOCUMENT, None) or (None, REDIRECT_LOCATION)
+        slot = self.slot(key)
+        slot.acquire()
+        try:
+            connection, reused = self.connection(key)
+            try:
+                try:
+                    response = self.request(connection, path)
+                except Exception:
+                    # the server may have dropped an idle connection
+                    connection.close()
+                    if not reused:
+                        raise
+                    connection, reused = self.connection(key, reuse=False)
+                    response = self.request(connection, path)
+                location = response.getheader('location')
+                if response.status in self.redirects and location:
+                    response.read()
+                    doc = None
+                elif response.status >= 400:
+                    response.read()
+                    raise IOError, ('http error', response.status,
+                                    response.reason)
+                else:
+                    doc = parser().read(response)
+                    location = None
+            except:
+                connection.close()
+                raise
+            self.lock.acquire()
+            try:
+                if response.will_close or self.closed:
+                    connection.close()
+                else:
+                    self.idle.setdefault(key, [ ]).append(connection)
+            finally:
+                self.lock.release()
+            return doc, location
+        finally:
+            slot.release()
+    def request(self, connection, path):
+        connection.putrequest('GET', path, skip_accept_encoding=True)
+        connection.putheader('User-Agent', self.user_agent)
+        connection.endheaders()
+        return connection.getresponse()
+    def slot(self, key):
+        self.lock.acquire()
+        try:
+            slot = self.slots.get(key)
+            if slot is None:
+                slot = self.slots[key] = threading.Semaphore(self.per_host)
+            return slot
+        finally:
+            self.lock.release()
+    def connection(self, key, reuse=True):
+        # => (CONNECTION, REUSED)
+        self.lock.acquire()
+        try:
+            idle = self.idle.get(key)
+            if reuse and idle:
+                return idle.pop(), True
+        finally:
+            self.lock.release()
+        import httplib
+        if key[0] == 'https':
+            connection_class = httplib.HTTPSConnection
+        else:
+            connection_class = httplib.HTTPConnection
+        if self.timeout is None:
+            return connection_class(key[1]), False
+        return connection_class(key[1], timeout=self.timeout), False
+    def close(self):
+        """closes the idle connections, and those in use once done."""
+        self.lock.acquire()
+        try:
+            self.closed = True
+            for connections in self.idle.values():
+                for connection in connections:
+                    connection.close()
+            self.idle.clear()
+        finally:
+            self.lock.release()
+
+# binary trees
+
+dumps_magic = 'HTB1'
+
+def dumps(e):
+    """the entity tree E as a compact binary string, see loads().
+
+    The tree is marshalled as a table of entity kinds, each a class
+    number and a (KEY, VALUE, ...) attribute tuple, and one list in
+    document order: each string as is and each entity as its kind
+    number and how many items its contents hold.
+    """
+    if isinstance(e, cursor):
+        e = e.delegate
+    classes = { }
+    class_names = [ ]
+    kinds = { }
+    kind_list = [ ]
+    ops = [ ]
+    work = [ e ]
+    while work:
+        c = work.pop()
+        if isinstance(c, basestring):
+            ops.append(c)
+            continue
+        if isinstance(c, cursor):
+            c = c.delegate
+        if not isinstance(c, entity):
+            raise TypeError, 'cannot dump %r' % type(c)
+        t = type(c)
+        i = classes.get(t)
+        if i is None:
+            i = classes[t] = len(class_names)
+            class_names.append(dumped_class_name(t))
+        a = c._attributes
+        if type(a) is not tuple:
+            a = tuple([ x for item in a.items() for x in item ])
+        try:
+            k = kinds.get((i, a))
+            if k is None:
+                k = kinds[i, a] = len(kind_list)
+                kind_list.append((i, a))
+        except TypeError:
+            # unhashable values, e.g. lists, get a kind of their own
+            k = len(kind_list)
+            kind_list.append((i, a))
+        ops.append(k)
+        ops.append(len(c.contents))
+        work.extend(reversed(c.contents))
+    return dumps_magic + marshal.dumps((class_names, kind_list, ops), 2)
+
+def dumped_class_name(t):
+    # '' for entity, the tag for registered classes, else MODULE:CLASS
+    if t is entity:
+        return ''
+    elif getattr(entities, quote_identifier(t.__name__), None) is t:
+        return t.__name__
+    else:
+        return '%s:%s' % (t.__module__, t.__name__)
+
+def loaded_class(name):
+    # only entity classes already imported: loads() imports nothing
+    if not name:
+        return entity
+    elif ':' in name:
+        module, name = name.split(':')
+        t = getattr(sys.modules.get(module), name, None)
+    else:
+        t = getattr(entities, quote_identifier(name), None)
+    if not (isinstance(t, type) and issubclass(t, entity)):
+        raise ValueError, 'not an entity class: %r' % name
+    return t
+
+def loads(data):
+    """the entity tree dumps() made DATA from.
+
+    DATA may be a string or a buffer, e.g. buffer(MMAP), which is
+    read without copying.  Entity classes other than the registered
+    ones must have been imported.  Like marshal, which it is built on,
+    loads() is not meant for data from untrusted sources.
+    """
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    if data[:4] != dumps_magic:
+        raise ValueError, 'not html.dumps() data'
+    class_names, kind_list, ops = marshal.loads(buffer(data, 4))
+    classes = map(loaded_class, class_names)
+    kinds = [ ]
+    for i, pairs in kind_list:
+        keys = pairs[::2]
+        tag = 'tag' in keys and pairs[2 * keys.index('tag') + 1] or None
+        if len(pairs) == 2 and tag is not None:
+            pairs = tag_pairs(tag)
+        kinds.append((classes[i], pairs, tag))
+    setslot = object.__setattr__
+    append = list.append
+    top = [ ]
+    # [ CONTENTS, ITEMS STILL TO COME ] for each unfinished entity
+    stack = [ [ top, 1 ] ]
+    ops = iter(ops)
+    for op in ops:
+        frame = stack[-1]
+        if type(op) is int:
+            tag_class, pairs, tag = kinds[op]
+            n = ops.next()
+            t = tag_class.__new__(tag_class)
+            setslot(t, 'contents', contents())
+            setslot(t, '_attributes', pairs)
+            setslot(t, '_tag', tag)
+            setslot(t, '_index', None)
+            setslot(t, '_cache', None)
+            append(frame[0], t)
+            frame[1] -= 1
+            if n:
+                stack.append([ t.contents, n ])
+                continue
+        else:
+            append(frame[0], op)
+            frame[1] -= 1
+        while stack and stack[-1][1] == 0:
+            stack.pop()
+    return top[0]
+
+# frozen trees
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class frozen_document(object):
+    """an entity tree as parallel arrays, for reading many nodes cheaply.
+
+    The nodes, entities and texts alike, are numbered in document order
+    from the root's 0, so the descendants of a node are the nodes after
+    it up to its subtree_end().
+
+    frozen_document.tags[N]               => number in tag_names, or -1
+                                             for a text
+    frozen_document.classes[N]            => number in class_list, or -1
+    frozen_document.parents[N]            => node, or -1 for the root
+    frozen_document.first_children[N]     => node, or -1
+    frozen_document.next_siblings[N]      => node, or -1
+    frozen_document.depths[N]
+    frozen_document.attribute_offsets[N]  => where the (KEY, VALUE, ...)
+                                             of N start in attribute_values,
+                                             attribute_offsets[N + 1] where
+                                             they end
+    frozen_document.text_offsets[N]       => where the text of N starts
+                                             in text, likewise
+    frozen_document.node(N)               => FROZEN_ENTITY or 'TEXT'
+    frozen_document.iter_text(N)          => iter([ 'TEXT'... ]) as in
+                                             N's as_text()
+    frozen_document.thaw(N)               => ENTITY tree
+
+    findall() and match() on its frozen_entity views test the columns
+    for tag, attribute, token and substring criteria (and their and_
+    and or_) and make cursors for hits only; other criteria get a
+    cursor for each node tested.  With numpy, and vectorize left on,
+    those criteria are tested a column at a time, see node_mask().
+    """
+    columns = ('tags', 'classes', 'parents', 'first_children',
+               'next_siblings', 'depths', 'attribute_offsets',
+               'text_offsets')
+    vectorize = numpy is not None
+    def __init__(self, root):
+        if isinstance(root, cursor):
+            root = root.delegate
+        for name in self.columns:
+            setattr(self, name, array('i'))
+        tags = self.tags
+        classes = self.classes
+        parents = self.parents
+        first_children = self.first_children
+        next_siblings = self.next_siblings
+        depths = self.depths
+        attribute_offsets = self.attribute_offsets
+        text_offsets = self.text_offsets
+        self.tag_names = [ ]
+        self.tag_ids = { }
+        self.class_list = [ ]
+        class_ids = { }
+        values = self.attribute_values = [ ]
+        # one copy of each attribute value string
+        shared = { }
+        texts = [ ]
+        text_length = 0
+        last_children = [ ]
+        work = [ (root, -1) ]
+        while work:
+            item, parent = work.pop()
+            if isinstance(item, cursor):
+                item = item.delegate
+            n = len(parents)
+            parents.append(parent)
+            first_children.append(-1)
+            next_siblings.append(-1)
+            last_children.append(-1)
+            if parent < 0:
+                depths.append(0)
+            else:
+                depths.append(depths[parent] + 1)
+                previous = last_children[parent]
+                if previous < 0:
+                    first_children[parent] = n
+                else:
+                    next_siblings[previous] = n
+                last_children[parent] = n
+            attribute_offsets.append(len(values))
+            text_offsets.append(text_length)
+            if isinstance(item, basestring):
+                tags.append(-1)
+                classes.append(-1)
+                texts.append(item)
+                text_length += len(item)
+                continue
+            elif not isinstance(item, entity):
+                raise TypeError, 'cannot freeze %r' % type(item)
+            tag = item.get_attribute('tag', AttributeNonexistent)
+            i = self.tag_ids.get(tag)
+            if i is None:
+                i = self.tag_ids[tag] = len(self.tag_names)
+                self.tag_names.append(tag)
+            tags.append(i)
+            t = type(item)
+            i = class_ids.get(t)
+            if i is None:
+                i = class_ids[t] = len(self.class_list)
+                self.class_list.append(t)
+            classes.append(i)
+            a = item._attributes
+            if type(a) is not tuple:
+                a = [ x for pair in a.items() for x in pair ]
+            for i in xrange(0, len(a), 2):
+                value = a[i + 1]
+                if type(value) is str:
+                    value = shared.setdefault(value, value)
+                values.append(a[i])
+                values.append(value)
+            work.extend([ (c, n) for c in reversed(item.contents) ])
+        attribute_offsets.append(len(values))
+        text_offsets.append(text_length)
+        self.text = ''.join(texts)
+        self.child_lists = lru(256)
+        # see own_text_nodes()
+        self.own_text = None
+        # numpy arrays made from the columns, see vector()
+        self.vectors = { }
+        # CRITERION => node_mask(CRITERION)
+        self.masks = lru(64)
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['child_lists']
+        del state['own_text']
+        del state['vectors']
+        del state['masks']
+        state['class_list'] = map(dumped_class_name, self.class_list)
+        return state
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.class_list = map(loaded_class, self.class_list)
+        self.child_lists = lru(256)
+        self.own_text = None
+        self.vectors = { }
+        self.masks = lru(64)
+    def __len__(self):
+        return len(self.parents)
+    def node(self, n):
+        if self.tags[n] < 0:
+            return self.text[self.text_offsets[n]:self.text_offsets[n + 1]]
+        return frozen_entity(self, n)
+    def children(self, n):
+        """(NODE...) of the contents of node N."""
+        found = self.child_lists.get(n)
+        if found is None:
+            found = [ ]
+            next_siblings = self.next_siblings
+            c = self.first_children[n]
+            while c >= 0:
+                found.append(c)
+                c = next_siblings[c]
+            found = tuple(found)
+            self.child_lists[n] = found
+        return found
+    def subtree_end(self, n):
+        """the first node after node N and its descendants."""
+        parents = self.parents
+        next_siblings = self.next_siblings
+        while n >= 0:
+            s = next_siblings[n]
+            if s >= 0:
+                return s
+            n = parents[n]
+        return len(parents)
+    def own_text_nodes(self):
+        """[ NODE... ], in order, of the entities with their own as_text().
+
+        Within the others, as_text() is the text of the text nodes.
+        """
+        found = self.own_text
+        if found is None:
+            own = [ i for i, t in enumerate(self.class_list)
+                    if t.as_text.im_func is not entity_as_text ]
+            found = [ ]
+            if own:
+                classes = self.classes
+                tags = self.tags
+                for n in xrange(len(tags)):
+                    if tags[n] >= 0 and classes[n] in own:
+                        found.append(n)
+            self.own_text = found
+        return found
+    def iter_text(self, n=0):
+        """yields the as_text() rendition of node N piece by piece.
+
+        The runs of text nodes between entities with their own
+        as_text() are sliced from text, without thawing anything.
+        """
+        text = self.text
+        offsets = self.text_offsets
+        own = self.own_text_nodes()
+        end = self.subtree_end(n)
+        i = bisect.bisect_left(own, n)
+        start = n
+        while i < len(own) and own[i] < end:
+            m = own[i]
+            if start < m:
+                yield text[offsets[start]:offsets[m]]
+            t = self.class_list[self.classes[m]].as_text.im_func
+            if t not in textless:
+                yield self.thaw(m).as_text()
+            start = self.subtree_end(m)
+            i = bisect.bisect_left(own, start, i)
+        if start < end:
+            yield text[offsets[start]:offsets[end]]
+    def get_attribute(self, n, key, default=None):
+        values = self.attribute_values
+        for i in xrange(self.attribute_offsets[n],
+                        self.attribute_offsets[n + 1], 2):
+            if values[i] == key:
+                return values[i + 1]
+        return default
+    def attribute_pairs(self, n):
+        return tuple(self.attribute_values[self.attribute_offsets[n]:
+                                           self.attribute_offsets[n + 1]])
+    def thaw(self, n=0):
+        """an entity tree like node N and its descendants were."""
+        if self.tags[n] < 0:
+            return self.node(n)
+        parents = self.parents
+        setslot = object.__setattr__
+        append = list.append
+        top = [ ]
+        # (NODE, CONTENTS) down to the node being thawed
+        stack = [ (parents[n], top) ]
+        for i in xrange(n, self.subtree_end(n)):
+            while stack[-1][0] != parents[i]:
+                stack.pop()
+            if self.tags[i] < 0:
+                append(stack[-1][1], self.node(i))
+                continue
+            tag_class = self.class_list[self.classes[i]]
+            pairs = self.attribute_pairs(i)
+            tag = self.tag_names[self.tags[i]]
+            if tag is AttributeNonexistent:
+                tag = None
+            elif len(pairs) == 2:
+                pairs = tag_pairs(tag)
+            t = tag_class.__new__(tag_class)
+            setslot(t, 'contents', contents())
+            setslot(t, '_attributes', pairs)
+            setslot(t, '_tag', tag)
+            setslot(t, '_index', None)
+            setslot(t, '_cache', None)
+            append(stack[-1][1], t)
+            stack.append((i, t.contents))
+        return top[0]
+    def vector(self, name):
+        """the column NAME as a numpy array sharing its memory."""
+        v = self.vectors.get(name)
+        if v is None:
+            v = numpy.frombuffer(getattr(self, name), numpy.intc)
+            self.vectors[name] = v
+        return v
+    def attribute_codes(self, key):
+        """(CODES, { VALUE: CODE }, [ VALUE... ]) for the attribute KEY.
+
+        CODES[N] is the number of node N's value in the list, or -1
+        where N has no KEY.  Unhashable values are listed, not mapped.
+        """
+        found = self.vectors.get(('attribute', key))
+        if found is not None:
+            return found
+        owners = self.vectors.get('owners')
+        if owners is None:
+            # the node and the key of each (KEY, VALUE) in attribute_values
+            sizes = numpy.diff(self.vector('attribute_offsets')) // 2
+            owners = numpy.repeat(numpy.arange(len(self)), sizes)
+            keys = numpy.empty(len(owners), object)
+            keys[:] = self.attribute_values[::2]
+            self.vectors['owners'] = owners
+            self.vectors['keys'] = keys
+        slots = numpy.flatnonzero(self.vectors['keys'] == key)
+        codes = numpy.empty(len(self), numpy.intc)
+        codes.fill(-1)
+        ids = { }
+        values = [ ]
+        attribute_values = self.attribute_values
+        for slot, n in zip(slots.tolist(), owners[slots].tolist()):
+            value = attribute_values[2 * slot + 1]
+            try:
+                code = ids.get(value)
+                if code is None:
+                    code = ids[value] = len(values)
+                    values.append(value)
+            except TypeError:
+                code = len(values)
+                values.append(value)
+            codes[n] = code
+        found = self.vectors[('attribute', key)] = (codes, ids, values)
+        return found
+    def node_mask(self, fn):
+        """(MASK, [ CRITERION... ]) for FN, tested numpy's way.
+
+        MASK marks the nodes that pass FN's tag, attribute, token and
+        substring tests (or None when there are none to do this way),
+        the criteria are what is left of FN to call on each of them.
+        """
+        form = criterion_form(fn)
+        if form[0] == 'outside':
+            return self.node_mask(form[1])
+        elif form[0] == 'attribute':
+            attr, value = form[1:]
+            if attr == 'tag' and value is not AttributeExists:
+                try:
+                    tag = self.tag_ids.get(value, -2)
+                except TypeError:
+                    tag = -2
+                return self.vector('tags') == tag, [ ]
+            codes, ids, values = self.attribute_codes(attr)
+            if value is AttributeExists:
+                return codes != -1, [ ]
+            try:
+                return codes == ids.get(value, -2), [ ]
+            except TypeError:
+                return None, [ fn ]
+        elif form[0] == 'token':
+            attr, word = form[1:]
+            codes, ids, values = self.attribute_codes(attr)
+            # holds[CODE + 1]: the value numbered CODE holds WORD
+            holds = numpy.array([ False ] + [ is_string(v) and word in v.split()
+                                              for v in values ], bool)
+            return holds[codes + 1], [ ]
+        elif form[0] == 'substring':
+            mask = self.substring_mask(form[1])
+            if mask is None:
+                return None, [ fn ]
+            return mask, [ ]
+        elif form[0] == 'and':
+            mask = None
+            rest = [ ]
+            for c in form[1:]:
+                m, more = self.node_mask(c)
+                if m is not None:
+                    if mask is None:
+                        mask = m
+                    else:
+                        mask = mask & m
+                rest.extend(more)
+            return mask, rest
+        elif form[0] == 'or':
+            mask = None
+            for c in form[1:]:
+                m, more = self.node_mask(c)
+                if m is None or more:
+                    return None, [ fn ]
+                if mask is None:
+                    mask = m
+                else:
+                    mask = mask | m
+            return mask, [ ]
+        return None, [ fn ]
+    def substring_mask(self, substring):
+        """the texts holding SUBSTRING, or None if it is not text's type."""
+        tags = self.vector('tags')
+        if not isinstance(substring, basestring):
+            return None
+        elif isinstance(substring, unicode) != isinstance(self.text, unicode):
+            # each find() would convert the whole text
+            return None
+        elif not substring:
+            return tags < 0
+        texts = self.vectors.get('texts')
+        if texts is None:
+            nodes = numpy.flatnonzero(tags < 0)
+            offsets = self.vector('text_offsets')
+            texts = self.vectors['texts'] = (nodes, offsets[nodes],
+                                             offsets[nodes + 1])
+        nodes, starts, ends = texts
+        mask = numpy.zeros(len(self), bool)
+        find = self.text.find
+        size = len(substring)
+        at = find(substring)
+        while at >= 0:
+            i = starts.searchsorted(at, 'right') - 1
+            if at + size <= ends[i]:
+                # found in text i: on to the next text
+                mask[nodes[i]] = True
+                at = find(substring, ends[i])
+            else:
+                at = find(substring, at + 1)
+        return mask
+    def node_test(self, fn, cursor_at):
+        """FN as a test of node numbers: criteria the columns can answer
+        are answered from them, others are called with CURSOR_AT(N)."""
+        form = criterion_form(fn)
+        tags = self.tags
+        get = self.get_attribute
+        if form[0] == 'outside':
+            return self.node_test(form[1], cursor_at)
+        elif form[0] == 'attribute':
+            attr, value = form[1:]
+            if attr == 'tag' and value is not AttributeExists:
+                try:
+                    tag = self.tag_ids.get(value, -2)
+                except TypeError:
+                    tag = -2
+                return lambda n: tags[n] == tag
+            elif value is AttributeExists:
+                return lambda n: (get(n, attr, AttributeNonexistent)
+                                  is not AttributeNonexistent)
+            return lambda n: get(n, attr, AttributeNonexistent) == value
+        elif form[0] == 'and':
+            # tag tests first, then the other attributes, like and_
+            def order(c):
+                form = criterion_form(c)
+                if form[0] == 'attribute':
+                    return form[1] != 'tag'
+                return 2
+            tests = [ self.node_test(c, cursor_at)
+                      for c in sorted(form[1:], key=order) ]
+            def and_(n):
+                for test in tests:
+                    if not test(n):
+                        return False
+                return True
+            return and_
+        elif form[0] == 'or':
+            tests = [ self.node_test(c, cursor_at) for c in form[1:] ]
+            def or_(n):
+                for test in tests:
+                    if test(n):
+                        return True
+                return False
+            return or_
+        elif form[0] == 'substring':
+            substring = form[1]
+            text = self.text
+            offsets = self.text_offsets
+            return lambda n: (tags[n] < 0 and
+                              text.find(substring, offsets[n],
+                                        offsets[n + 1]) >= 0)
+        elif form[0] == 'token':
+            attr, word = form[1:]
+            def token(n):
+                value = get(n, attr)
+                return is_string(value) and word in value.split()
+            return token
+        return lambda n: fn(cursor_at(n))
+    def iter_findall(self, root, fn, nest, min_depth, max_depth,
+                     depth_first, skip=None, prune=None):
+        """searchable.iter_findall() under ROOT, a cursor of a view.
+
+        Entities tagged one of SKIP, or for which PRUNE(CURSOR), are not
+        searched within.
+        """
+        counting = stats.enabled
+        tags = self.tags
+        parents = self.parents
+        depths = self.depths
+        start = root.delegate.node
+        # depths are counted from ROOT's, as cursors count them
+        base = depths[start] - root.depth
+        # cursors of entities, so hits share their parents' cursors
+        made = { start: root }
+        first_children = self.first_children
+        next_siblings = self.next_siblings
+        # { PARENT: (CHILD, INDEX) } of the last child placed: hits come
+        # in order, so siblings are counted on from there
+        placed = { }
+        def which_child(n):
+            p = parents[n]
+            c, i = placed.get(p, (n + 1, 0))
+            if c > n:
+                c = first_children[p]
+                i = 0
+            while c != n:
+                c = next_siblings[c]
+                i += 1
+            placed[p] = (n, i)
+            return i
+        def cursor_at(n):
+            pending = [ ]
+            while n not in made:
+                pending.append(n)
+                n = parents[n]
+            c = made[n]
+            for n in reversed(pending):
+                c = cursor(self.node(n), c, which_child(n), depths[n] - base)
+                if tags[n] >= 0:
+                    if len(made) > 4096:
+                        made.clear()
+                        made[start] = root
+                        placed.clear()
+                    made[n] = c
+            return c
+        # the SKIP tags by number
+        skip = set([ self.tag_ids[tag] for tag in skip or ()
+                     if tag in self.tag_ids ])
+        if prune:
+            def pruned(n):
+                return tags[n] in skip or (tags[n] >= 0 and
+                                           prune(cursor_at(n)))
+        elif skip:
+            pruned = lambda n: tags[n] in skip
+        else:
+            pruned = None
+        mask = None
+        if self.vectorize and not prune:
+            found = self.masks.get(fn)
+            if found is None:
+                found = self.masks[fn] = self.node_mask(fn)
+            mask, rest = found
+        if mask is not None:
+            for n in self.masked_findall(start, base, mask, [
+                self.node_test(c, cursor_at) for c in rest ],
+                nest, min_depth, max_depth, depth_first, skip):
+                yield cursor_at(n)
+            return
+        test = self.node_test(fn, cursor_at)
+        visited = tested = 0
+        try:
+            if depth_first:
+                # document order is node order: a scan, skipping the
+                # subtrees the search would not descend into
+                end = self.subtree_end(start)
+                n = start
+                while n < end:
+                    depth = depths[n] - base
+                    if counting:
+                        visited += 1
+                    if depth >= min_depth:
+                        if counting:
+                            tested += 1
+                        if test(n):
+                            yield cursor_at(n)
+                            if not nest:
+                                n = self.subtree_end(n)
+                                continue
+                    if depth < max_depth and not (pruned and pruned(n)):
+                        n += 1
+                    else:
+                        n = self.subtree_end(n)
+            else:
+                work = deque([ start ])
+                while work:
+                    n = work.popleft()
+                    depth = depths[n] - base
+                    if counting:
+                        visited += 1
+                    if depth >= min_depth:
+                        if counting:
+                            tested += 1
+                        if test(n):
+                            yield cursor_at(n)
+                            if not nest:
+                                continue
+                    if depth < max_depth and not (pruned and pruned(n)):
+                        c = first_children[n]
+                        while c >= 0:
+                            work.append(c)
+                            c = next_siblings[c]
+        finally:
+            if counting:
+                stats.count('findall nodes visited', visited)
+                stats.count('findall predicate calls', tested)
+
+    def masked_findall(self, start, base, mask, tests, nest, min_depth,
+                       max_depth, depth_first, skip=()):
+        """iter_findall()'s hits as nodes: those MASK marks within the
+        depths searched and outside entities tagged one of the SKIP
+        numbers, that pass TESTS and, unless NEST, are not within
+        another hit."""
+        end = self.subtree_end(start)
+        depths = self.vector('depths')[start:end] - base
+        window = mask[start:end] & (depths >= min_depth)
+        if max_depth < sys.maxint:
+            window &= depths <= max_depth
+        if skip:
+            # +1 where a skipped subtree starts, -1 past its end
+            tags = self.vector('tags')[start:end]
+            edges = numpy.zeros(end - start + 1, numpy.intc)
+            for n in (numpy.flatnonzero(numpy.in1d(tags, list(skip)))
+                      + start).tolist():
+                edges[n + 1 - start] += 1
+                edges[self.subtree_end(n) - start] -= 1
+            window &= numpy.cumsum(edges[:-1]) == 0
+        candidates = (numpy.flatnonzero(window) + start).tolist()
+        if stats.enabled:
+            stats.count('findall vectorized')
+            stats.count('findall nodes visited', len(candidates))
+        def hits():
+            skip = -1
+            for n in candidates:
+                if n < skip:
+                    continue
+                for test in tests:
+                    if not test(n):
+                        break
+                else:
+                    yield n
+                    if not nest:
+                        skip = self.subtree_end(n)
+        if depth_first:
+            return hits()
+        # the same hits, level by level
+        found = list(hits())
+        found.sort(key=self.depths.__getitem__)
+        return found
+
+class frozen_entity(searchable, renderable):
+    """read-only view of an entity in a frozen_document.
+
+    It reads like an entity: frozen_entity.tag, .ATTR, ['ATTR'], [N],
+    len(), iter(), 'SUBSTRING' in and the searchable methods.  Changes
+    raise TypeError.
+
+    frozen_entity.document         => FROZEN_DOCUMENT
+    frozen_entity.node             => its number there
+    frozen_entity.contents         => (FROZEN_ENTITY or 'TEXT'...)
+    frozen_entity.thaw()           => ENTITY tree to change
+    """
+    __slots__ = ('document', 'node')
+    def __init__(self, document, node):
+        object.__setattr__(self, 'document', document)
+        object.__setattr__(self, 'node', node)
+    def __reduce__(self):
+        return (frozen_entity, (self.document, self.node))
+    def __eq__(self, other):
+        return (isinstance(other, frozen_entity)
+                and self.document is other.document
+                and self.node == other.node)
+    def __ne__(self, other):
+        return not self.__eq__(other)
+    def __hash__(self):
+        return hash((id(self.document), self.node))
+    def __contains__(self, item):
+        if isinstance(item, type):
+            document = self.document
+            for n in document.children(self.node):
+                if (document.tags[n] >= 0
+                    and document.class_list[document.classes[n]] == item):
+                    return True
+            return False
+        elif (self.get_attribute(item, AttributeNonexistent)
+              is not AttributeNonexistent):
+            return True
+        elif item in self.contents:
+            return True
+        return searchable.__contains__(self, item)
+    def __len__(self):
+        return len(self.document.children(self.node))
+    def __iter__(self):
+        return iter(self.contents)
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            return self.document.node(self.document.children(self.node)[key])
+        elif isinstance(key, slice):
+            return self.contents[key]
+        value = self.get_attribute(key, AttributeNonexistent)
+        if value is AttributeNonexistent:
+            raise KeyError, key
+        return value
+    def get_contents(self):
+        node = self.document.node
+        return tuple([ node(n) for n in self.document.children(self.node) ])
+    contents = property(get_contents)
+    def get_tag(self):
+        tag = self.document.tag_names[self.document.tags[self.node]]
+        if tag is AttributeNonexistent:
+            return None
+        return tag
+    tag = property(get_tag)
+    def get_attribute(self, key, default=None):
+        return self.document.get_attribute(self.node, key, default)
+    def get(self, key, default=None):
+        if is_index_or_slice(key):
+            return self[key]
+        return self.get_attribute(key, default)
+    def attribute_dict(self):
+        pairs = self.document.attribute_pairs(self.node)
+        return dict(zip(pairs[::2], pairs[1::2]))
+    attributes = property(attribute_dict)
+    def keys(self):
+        return [ k for k in self.attribute_dict() if k != 'tag' ]
+    def __getattr__(self, attr):
+        if attr in frozen_entity.__slots__:
+            # not set yet
+            raise AttributeError, attr
+        value = self.get_attribute(dequote_identifier(attr),
+                                   AttributeNonexistent)
+        if value is AttributeNonexistent:
+            return searchable.__getattr__(self, attr)
+        return value
+    def read_only(self, *args):
+        raise TypeError, 'frozen entities are read-only, thaw() one'
+    __setattr__ = __delattr__ = __setitem__ = __delitem__ = read_only
+    def iter_findall(self, fn, nest=1, min_depth=1, max_depth=sys.maxint,
+                     depth_first=True, prune=None):
+        skip, prune = pruning(prune, fn)
+        return self.document.iter_findall(cursor(self, None, None, 0), fn,
+                                          nest, min_depth, max_depth,
+                                          depth_first, skip, prune)
+    def thaw(self):
+        return self.document.thaw(self.node)
+    # rendered from a thawed copy, but for the text
+    def as_html(self, out=None, escape=False):
+        return self.thaw().as_html(out, escape)
+    def iter_html(self, escape=False):
+        return self.thaw().iter_html(escape)
+    def as_python(self, module_prefix=None):
+        return self.thaw().as_python(module_prefix)
+    def as_text(self):
+        return ''.join(self.document.iter_text(self.node))
+    def iter_text(self):
+        return self.document.iter_text(self.node)
+    def as_info(self):
+        # as the thawed entity's, from its first two items at most
+        document = self.document
+        t = document.class_list[document.classes[self.node]]
+        tag = self.tag
+        pairs = document.attribute_pairs(self.node)
+        a = attributes()
+        for i in xrange(0, len(pairs), 2):
+            dict.__setitem__(a, pairs[i], pairs[i + 1])
+        items = contents([ document.node(n)
+                           for n in document.children(self.node)[:2] ])
+        return '<%s.%s %d <%s.%s [<%s%s>%s]>>' % (
+            self.__module__, self.__class__.__name__, self.node,
+            t.__module__, t.__name__, tag, substfmt(a.as_info(), ' %s'),
+            substfmt(items.as_info(), '%%s</%s>' % tag))
+
+# as_text() methods known to render nothing
+textless = frozenset((quiet_entity.as_text.im_func,
+                      document.as_text.im_func))
+
+def freeze(e):
+    """a frozen_entity view of the entity tree E, as a frozen_document."""
+    return frozen_document(e).node(0)
+
 def testdoc():
     return html(body('foo', br(), p('bar', class_=42), bgcolor='black'))
 
 def tests():
     #import sys
     #tagng = sys.modules[__name__]
+    tests_findall()
+    tests_cursors()
+    tests_render()
+    tests_parser()
+    tests_iterparse()
+    tests_criteria()
+    tests_lru()
+    tests_index()
+    tests_select()
+    tests_contains()
+    tests_attributes()
+    tests_parse_many()
+    tests_fetch()
+    tests_openfile()
+    tests_matches()
+    tests_starttags()
+    tests_malformed()
+    tests_stats()
+    tests_cache()
+    tests_pickle()
+    tests_bulk()
+    tests_escape()
+    tests_binary()
+    tests_frozen()
+    tests_numpy()
+    tests_prune()
+    tests_cache_roots()
+    tests_matches_bounded()
+    tests_bulk_keys()
+    tests_iterparse_bounded()
+    tests_fetch_stop()
+    tests_frozen_text()
+    tests_attribute_values()
+    tests_starttag_attributes()
+    tests_index_members()
+    tests_iterparse_text()
+    tests_binary_values()
+    tests_lru_threads()
     d = testdoc()
     d.body
     d.body.attributes
@@ -1065,3 +3804,833 @@ def tests():
     d.attributes['CLASS'] = 'not a class'
     d.all_has_class
     d.all_by_bgcolor_black
+
+def tests_findall():
+    d = div(p('a', b('x')), p(i('y')), id_='top')
+    assert([ c.tag for c in d.findall(is_entity) ] == [ 'p', 'b', 'p', 'i' ])
+    assert([ c.tag for c in d.findall(is_entity, depth_first=False) ]
+           == [ 'p', 'p', 'b', 'i' ])
+    assert([ c.tag for c in d.findall(is_entity, nest=0) ] == [ 'p', 'p' ])
+    assert(len(list(d.findall(is_entity, max_depth=1))) == 2)
+    assert([ str(c) for c in d.findall(lambda c: True, min_depth=3) ]
+           == [ 'x', 'y' ])
+    # deep trees are walked without recursion
+    e = d
+    for n in range(5000):
+        e = div(e)
+    assert(len(list(e.findall(by.b))) == 1)
+
+def tests_cursors():
+    d = div(p('a', b('x')), p(i('y')))
+    c = list(d.findall(by.b))[0]
+    assert(c.parent.tag == 'p')
+    assert(c.depth == 2)
+    assert([ a.tag for a in c.path ] == [ 'div', 'p', 'b' ])
+    assert(c.parent.next.tag == 'p')
+    assert(c.parent.next.previous.delegate is c.parent.delegate)
+    c.title = 'bold'
+    assert(d.contents[0].contents[1].title == 'bold')
+
+def tests_render():
+    import StringIO
+    d = div(p('a', br(), b('x'), class_='c'), comment(' c '), object_('q'))
+    rendition = '<div><p class="c">a<br><b>x</b></p><!-- c --></div>'
+    assert(str(d) == rendition)
+    assert(''.join(d.iter_html()) == rendition)
+    out = StringIO.StringIO()
+    d.as_html(out)
+    assert(out.getvalue() == rendition)
+    e = d
+    for n in range(5000):
+        e = div(e)
+    assert(str(e) == '<div>' * 5000 + rendition + '</div>' * 5000)
+
+def testpage():
+    return parse('''<!DOCTYPE html><html><head><title>T &amp; x</title>
+<style>td { x }</style><script>if (a<b) { s = "</td>" }</script></head>
+<body bgcolor="black"><table class="report" id="t1">
+<tr><td class="a b">1<td>2<td class="price">3</tr>
+<tr><th>h<td>x<b>bold</b>y</td><td id="z" class="price">$5</td></tr></table>
+<p>para one<p>para <i>two</i> &copy; &#169; <img src="a.png" width="64"><br>
+<div><div><span>deep <em>deeper</em></span></div></div><!-- c -->
+<object>quiet<p>not text</p></object></body></html>''')
+
+def tests_parser():
+    # tag soup comes out as it always has
+    for source, rendition in [
+        ('<p>a<p>b', '<p>a</p><p>b</p>'),
+        ('<table><tr><td>1<td>2<tr><td>3</table>',
+         '<table><tr><td>1</td><td>2<tr><td>3</td></tr></td></tr></table>'),
+        ('<div><b>x</i>y</b></div>', '<div><b>xy</b></div>'),
+        ('<ul><li>a</ul></li>z', '<ul><li>a</li></ul>z'),
+        ('<div><span>a</div>b', '<div><span>a</span></div>b'),
+        ('</b>text', 'text'),
+        ('<script>if (a<b) "</p>"</script>',
+         '<script>if (a<b) "</p>"</script>'),
+        ('<p>a &amp; &copy; &#169;<br>b<img src=x></p>',
+         '<p>a &amp; &copy; &#169;<br>b<img src="x"></p>'),
+        ('<!-- c --><select><option>a<option>b</select>',
+         '<!-- c --><select><option>a</option><option>b</option></select>'),
+        ]:
+        assert(str(parse(source)) == rendition)
+    d = parse('<div><span>a</div>b')
+    assert(d.contents[-1] == 'b')
+    assert(d.contents[0].contents[0].contents == [ 'a' ])
+    d = testpage()
+    assert(str(parse(str(d))) == str(d))
+    assert(parse(str(d)) == d)
+    script = list(d.findall(by.script))[0]
+    assert(script.contents == [ 'if (a<b) { s = "</td>" }' ])
+
+def tests_iterparse():
+    import StringIO
+    events = [ (event, t.tag) for event, t in iterparse(
+        StringIO.StringIO('<div><p>a<p>b</div>'), ('start', 'end')) ]
+    assert(events == [ ('start', 'div'), ('start', 'p'), ('end', 'p'),
+                       ('start', 'p'), ('end', 'p'), ('end', 'div'),
+                       ('end', 'document') ])
+    # discarded rows leave the table as they are handled
+    rows = ''.join([ '<tr><td>%d</td></tr>\n' % i for i in range(10000) ])
+    found = 0
+    for event, t in iterparse(StringIO.StringIO('<table>\n%s</table>' % rows),
+                              ('start', 'end'), discard=('tr',)):
+        if event == 'start' and t.tag == 'table':
+            table = t
+        elif event == 'end' and t.tag == 'tr':
+            assert(t.as_text() == str(found))
+            found += 1
+    assert(found == 10000)
+    assert(not [ c for c in table.contents if is_entity(c) ])
+
+def tests_criteria():
+    d = div(p('alpha', class_='x'), p('beta'), b('gamma', class_='x'),
+            i('delta', id_='y'))
+    def tags(fn):
+        return [ c.tag for c in d.findall(fn) ]
+    assert(tags(by.and_(by.p, by.has_class)) == [ 'p' ])
+    assert(tags(by.and_(by.class_('x'),
+                     lambda c: c.contents == [ 'gamma' ])) == [ 'b' ])
+    assert(tags(by.or_(by.b, by.i)) == [ 'b', 'i' ])
+    assert([ str(c) for c in d.findall(by.or_(by.substring('gamma'),
+                                              by.substring('beta'))) ]
+           == [ 'beta', 'gamma' ])
+    assert(tags(by.or_(by.id('y'), by.and_(by.p, by.has_class)))
+           == [ 'p', 'i' ])
+    assert(tags(by.and_(by.p, lambda c: c.contents == [ 'beta' ])) == [ 'p' ])
+    assert(by.and_(by.p, by.has_class)(p(class_='x')) is True)
+    assert(by.or_(by.b, by.i)(p()) is False)
+
+def tests_lru():
+    cache = lru(2)
+    cache['a'] = 1
+    cache['b'] = 2
+    assert(cache.get('a') == 1)
+    cache['c'] = 3
+    # b was the least recently used
+    assert('b' not in cache and 'a' in cache and 'c' in cache)
+    assert(cache.get('b', 0) == 0)
+    assert((cache.hits, cache.misses) == (1, 1))
+    assert(len(cache) == 2)
+    cache.clear()
+    assert((len(cache), cache.hits, cache.misses) == (0, 0, 0))
+    # dynamic names are resolved once
+    criterion_names.clear()
+    by.has_class
+    by.has_class
+    assert((criterion_names.hits, criterion_names.misses) == (1, 1))
+    d = div(p('a', class_='x'))
+    assert(d.p.contents == [ 'a' ])
+    assert(len(d.all_has_class) == 1)
+    try:
+        d.no_such_thing
+    except AttributeError:
+        pass
+    else:
+        assert(False)
+
+def tests_index():
+    d = testpage()
+    criteria = [ by.td, by.class_('price'), by.id('z'),
+                 by.and_(by.td, by.class_('price')) ]
+    walked = [ [ (c.depth, str(c)) for c in d.findall(fn) ]
+               for fn in criteria ]
+    d.tree_index()
+    for fn, found in zip(criteria, walked):
+        assert([ (c.depth, str(c)) for c in d.findall(fn) ] == found)
+        assert([ (c.depth, str(c))
+                 for c in d.findall(fn, depth_first=False) ]
+               == [ (c.depth, str(c))
+                    for c in d.findall(lambda c: fn(c), depth_first=False) ])
+    # edits make the index stale
+    cell = td('new', class_='price')
+    list(d.findall(by.tr))[0].delegate.append(cell)
+    assert(len(list(d.findall(by.class_('price')))) == 3)
+    cell.attributes['class'] = 'cheap'
+    assert(len(list(d.findall(by.class_('price')))) == 2)
+
+def tests_select():
+    d = testpage()
+    def selected(selector):
+        return [ str(c) for c in d.select(selector) ]
+    assert(len(selected('table td.price')) == 2)
+    assert(selected('#z') == selected('td#z'))
+    assert(len(selected('#z')) == 1)
+    assert(selected('td.a.b') == [ '<td class="a b">1</td>' ])
+    assert(selected('td:first-child')
+           == [ '<td class="a b">1</td>', '<td>x<b>bold</b>y</td>' ])
+    assert(selected('img[width=64]') == selected('[src="a.png"]'))
+    assert(len(selected('tr > td')) == 3)
+    assert(len(selected('td + td')) == 3)
+    assert(len(selected('b, i, em')) == 3)
+    assert(selected('div div span > em') == [ '<em>deeper</em>' ])
+    try:
+        d.select('td::after')
+    except ValueError:
+        pass
+    else:
+        assert(False)
+
+def tests_contains():
+    d = div('ab', b('cd'), object_('hidden'), p('ef', i('gh')))
+    assert('bc' in d)
+    assert('abcdefgh' in d)
+    assert('hidden' not in d)
+    assert('abcdefghi' not in d)
+    assert('' in d)
+    assert(''.join(d.contents.iter_text()) == 'abcdefgh')
+    assert(('cd' in d) == ('cd' in d.as_text()))
+
+def tests_attributes():
+    import pickle
+    assert(p('a')._attributes is p('b')._attributes)
+    e = td('x', class_='c', width=3)
+    assert(type(e._attributes) is tuple)
+    assert((e.tag, e.class_, e['width'], e.get('height', 0))
+           == ('td', 'c', 3, 0))
+    assert('width' in e and 'height' not in e)
+    assert(sorted(e.keys()) == [ 'class', 'width' ])
+    assert(by.class_('c')(e) and by.has_width(e))
+    assert(pickle.loads(pickle.dumps(e, 2)) == e)
+    rendition = str(e)
+    e.attributes
+    assert(type(e._attributes) is not tuple)
+    assert(str(e) == rendition)
+    e.attributes['width'] = 4
+    assert(e.width == 4 and e.get('width') == 4)
+    e.tag = 'th'
+    assert(str(e).startswith('<th '))
+    try:
+        e.height
+    except AttributeError:
+        pass
+    else:
+        assert(False)
+
+def tests_parse_many():
+    sources = [ '<p>%d<b>x</b>' % i for i in range(20) ]
+    for workers in (0, 2):
+        found = list(parse_many(sources, workers))
+        assert([ source for source, doc, error in found ] == sources)
+        assert([ doc for source, doc, error in found ]
+               == map(parse, sources))
+        assert([ error for source, doc, error in found ] == [ None ] * 20)
+        found = list(parse_many(sources, workers, ordered=False))
+        assert(sorted([ source for source, doc, error in found ])
+               == sorted(sources))
+        # a failing source comes with its error
+        found = list(parse_many([ '<p>a', '/no/such/file.html' ], workers,
+                                load=openfile))
+        assert(found[0][2] is not None and found[1][2] is not None)
+        found = list(parse_many([ '<p>a', 42 ], workers))
+        assert(found[0][1] == parse('<p>a') and found[1][1] is None)
+        assert(isinstance(found[1][2], Exception))
+
+def tests_fetch():
+    import htmlbench
+    pages = dict([ ('/%d' % i, '<p>page %d<b>x</b>' % i) for i in range(12) ])
+    server, base = htmlbench.serve(pages, latency=0.005)
+    try:
+        urls = [ base + '/%d' % i for i in range(12) ]
+        found = list(fetch_and_parse(urls + [ base + '/missing',
+                                              'ftp://example.com/' ]))
+        assert(len(found) == 14)
+        docs = dict([ (url, doc) for url, doc, error in found if not error ])
+        assert(sorted(docs) == sorted(urls))
+        for url in urls:
+            assert(str(docs[url]) == str(parse(pages[url[len(base):]])))
+            assert(docs[url].url == url)
+        errors = dict([ (url, error) for url, doc, error in found if error ])
+        assert(sorted(errors) == [ 'ftp://example.com/', base + '/missing' ])
+        assert(errors[base + '/missing'].args[1] == 404)
+        assert(isinstance(errors['ftp://example.com/'], IOError))
+        # one worker fetches in order
+        assert([ url for url, doc, error in fetch_and_parse(urls, 1) ]
+               == urls)
+    finally:
+        server.shutdown()
+
+def tests_openfile():
+    import os
+    import tempfile
+    data = str(testpage()) * 40
+    fd, path = tempfile.mkstemp('.html')
+    try:
+        os.write(fd, data)
+        os.close(fd)
+        assert(str(openfile(path, mmap=True)) == str(parse(data)))
+        assert(str(openfile(path)) == str(parse(data)))
+        open(path, 'w').close()
+        assert(str(openfile(path, mmap=True)) == '')
+    finally:
+        os.remove(path)
+
+def tests_matches():
+    d = testpage()
+    tds = d.findall(by.td)
+    assert(isinstance(tds, matches))
+    assert(tds)
+    assert(len(tds.matches) == 1)
+    assert(len(tds[1:3]) == 2)
+    assert(str(tds[1:3][0]) == str(tds[1]))
+    assert(len(tds.matches) == 3)
+    assert(str(tds[-1]) in ('<td id="z" class="price">$5</td>',
+                            '<td class="price" id="z">$5</td>'))
+    assert(len(tds) == 5)
+    assert([ str(c) for c in tds ] == [ str(c) for c in list(tds) ])
+    assert(len(tds.parents) == 2)
+    assert(not d.findall(by.blink))
+    # matches within matches
+    m = div(div(div(span(), id_='in'), id_='mid')).findall(by.div)
+    assert(len(m) == 2)
+    assert(len(m.findall(by.span)) == 1)
+    assert(len(m.findall(by.div)) == 1)
+    assert(len(d.findall(by.div).findall(by.or_(by.span, by.em))) == 2)
+
+def tests_starttags():
+    d = parse('<p class="x" id=y>a<object>q</object><br><font size=2>'
+              '<x-y z=1>b</x-y><p>c')
+    first = d.contents[0]
+    assert(type(first) is p)
+    assert((first.class_, first.id) == ('x', 'y'))
+    assert(first.contents[1].tag == 'object')
+    assert(type(first.contents[2]) is br and first.contents[2].contents == [ ])
+    assert(type(first.contents[3]) is font and first.contents[3].size == '2')
+    custom = first.contents[3].contents[0]
+    assert(type(custom) is entity and custom.tag == 'x-y')
+    assert(p('c')._attributes is first.contents[3].contents[1]._attributes)
+    assert(str(d) in ('<p class="x" id="y">a<object>q</object><br>'
+                      '<font size="2"><x-y z="1">b</x-y><p>c</p></font></p>',
+                      '<p id="y" class="x">a<object>q</object><br>'
+                      '<font size="2"><x-y z="1">b</x-y><p>c</p></font></p>'))
+
+def tests_malformed():
+    import StringIO
+    # stray end tags are dropped, mismatched ones close what they match
+    d = parse('<div><span>x</p></em>y</div>z</b>')
+    assert(str(d) == '<div><span>xy</span></div>z')
+    source = '<div><span>x</p>' * 500 + '</em>' * 500
+    d = parse(source)
+    depth = 0
+    e = d
+    while e.contents:
+        e = e.contents[-1]
+        if is_string(e):
+            break
+        depth += 1
+    assert(depth == 1000)
+    d = parse(source + '</div>' * 10)
+    assert(len(d.findall(by.div, nest=0)) == 1)
+    events = [ (event, t.tag) for event, t in iterparse(
+        StringIO.StringIO('<div><b><i>x</div>y</b>'), ('start', 'end')) ]
+    assert(events == [ ('start', 'div'), ('start', 'b'), ('start', 'i'),
+                       ('end', 'i'), ('end', 'b'), ('end', 'div'),
+                       ('end', 'document') ])
+
+def tests_stats():
+    import StringIO
+    stats.reset()
+    d = parse('<p>a<b>x</b><!-- c --></p>')
+    assert(stats.counters == { } and not stats.enabled)
+    with stats:
+        d = parse('<p>a<b>x</b><!-- c --></p>')
+        assert(len(d.findall(by.b)) == 1)
+        str(d)
+        d.as_html(StringIO.StringIO())
+    assert(not stats.enabled)
+    counters = stats.counters
+    assert(counters['parser start tags'] == 2)
+    assert(counters['parser end tags'] == 2)
+    assert(counters['parser comments'] == 1)
+    assert(counters['findall nodes visited'] == 7)
+    assert(counters['findall predicate calls'] == 6)
+    assert(counters['render calls'] == 2)
+    assert(counters['render bytes'] == 2 * len(str(d)))
+    assert('parse' in stats.timers and 'render' in stats.timers)
+    assert('findall nodes visited' in str(stats))
+    stats.reset()
+    assert(stats.counters == { } and stats.timers == { })
+
+def tests_cache():
+    d = testpage()
+    rendition = str(d)
+    d.cache_rendering()
+    assert(str(d) == rendition and str(d) == rendition)
+    cell = d.findall(by.td)[1].delegate
+    cell.append('!')
+    assert(str(d) == rendition.replace('<td>2</td>', '<td>2!</td>'))
+    cell.attributes['class'] = 'c'
+    assert('<td class="c">2!</td>' in str(d))
+    del cell[-1]
+    e = d.search(by.body).delegate
+    assert(e.as_text() == parse(str(d)).search(by.body).as_text())
+    e.contents[-1:] = [ 'end' ]
+    assert(e.as_text().endswith('end'))
+    assert(str(d).endswith('end</body></html>'))
+    d.cache_rendering(False)
+    assert(str(d) == str(parse(str(d))))
+
+def tests_pickle():
+    import copy, cPickle
+    d = testpage()
+    d.url = 'http://example.com/'
+    e = cPickle.loads(cPickle.dumps(d, 2))
+    assert(str(e) == str(d) and e.url == d.url)
+    assert(type(e.attributes) is type(d.attributes))
+    assert(not e.attributes.__dict__)
+    e = copy.deepcopy(d)
+    assert(str(e) == str(d) and e.url == d.url)
+    try:
+        d.attributes.__missing__
+        assert(False)
+    except AttributeError:
+        pass
+
+def tests_bulk():
+    d = testpage()
+    tds = d.findall(by.td)
+    assert(tds.set(class_='cell', title='t') is tds)
+    for c in tds:
+        assert(c.delegate["class"] == "cell" and c.delegate["title"] == "t")
+    assert(type(d.search(by.td).delegate._attributes) is tuple)
+    d.findall(by.th).update_attrs(lambda c: { 'scope': 'row' })
+    assert('<th scope="row">h' in str(d))
+    wrapped = d.findall(by.img).wrap('a', href='b.html')
+    assert(len(wrapped) == 1 and wrapped[0].tag == 'a')
+    assert('<a href="b.html"><img ' in str(d))
+    wrapped = d.findall(by.em).wrap('x-y')
+    assert('<x-y><em>deeper</em></x-y>' in str(d))
+    assert(d.findall(by.td).remove() == 5)
+    assert(not d.findall(by.td))
+    assert('<th scope="row">h</th></tr>' in str(d))
+    try:
+        d.findall(by.html).parents.remove()
+        assert(False)
+    except ValueError:
+        pass
+
+def tests_escape():
+    assert(sgml_escape('plain') == 'plain')
+    assert(sgml_escape('a < b & c > d') == 'a &lt; b &amp; c &gt; d')
+    assert(sgml_escape_quotes_too('say "&"') == 'say &quot;&amp;&quot;')
+    e = div('a < b & c', script('a<b'), comment(' x<y '), title='"q" & r')
+    assert(e.as_html() ==
+           '<div title="&quot;q&quot; &amp; r">a < b & c'
+           '<script>a<b</script><!-- x<y --></div>')
+    assert(e.as_html(escape=True) ==
+           '<div title="&quot;q&quot; &amp; r">a &lt; b &amp; c'
+           '<script>a<b</script><!-- x<y --></div>')
+    assert(''.join(e.iter_html(escape=True)) == e.as_html(escape=True))
+    e.cache_rendering()
+    str(e)
+    assert('a &lt; b' in e.as_html(escape=True))
+    assert(str(e) == e.as_html())
+    d = testpage()
+    assert(d.as_html() == str(d))
+    e = div(p('x', class_='c'), br())
+    assert(e.as_html() == '<div><p class="c">x</p><br></div>')
+
+def tests_binary():
+    import cPickle
+    d = testpage()
+    data = d.dumps()
+    assert(data == dumps(d) and data.startswith(dumps_magic))
+    e = loads(data)
+    assert(e == d and str(e) == str(d))
+    assert(type(e) is document and type(e.search(by.p).delegate) is p)
+    assert(e.findall(by.td)[3].delegate._attributes is
+           e.findall(by.td)[1].delegate._attributes)
+    assert(loads(buffer(data)) == d and loads(memoryview(data)) == d)
+    assert(cPickle.loads(cPickle.dumps(e, 2)) == d)
+    e.search(by.td).delegate.append('!')
+    assert(e != d and str(loads(e.dumps())) == str(e))
+    t = div('a', entity(tag='x-y', id_='1'), u'\xe9')
+    assert(loads(dumps(cursor(t, None, None))) == t)
+    assert(loads(dumps(t)).contents[1].tag == 'x-y')
+    try:
+        loads('<html></html>')
+        assert(False)
+    except ValueError:
+        pass
+    try:
+        dumps(div(object()))
+        assert(False)
+    except TypeError:
+        pass
+
+def tests_frozen():
+    d = testpage()
+    f = d.freeze()
+    assert(isinstance(f, frozen_entity) and freeze(d).thaw() == d)
+    assert(f.thaw() == d and str(f) == str(d))
+    assert(f.tag == d.tag and len(f) == len(d))
+    t = f.search(by.table)
+    assert(t.delegate['class'] == 'report' and t.id == 't1')
+    for criterion in [ by.td, by.p, by.has_class, by.class_('price'),
+                       by.id('z'), by.substring('para'),
+                       by.and_(by.td, by.class_('price')),
+                       by.or_(by.th, by.i), lambda c: is_entity(c) and c.tag == 'b',
+                       by.token('class', 'b') ]:
+        for kw in [ { }, dict(depth_first=False), dict(max_depth=4),
+                    dict(min_depth=5), dict(nest=False) ]:
+            assert([ str(c) for c in f.findall(criterion, **kw) ] ==
+                   [ str(c) for c in d.findall(criterion, **kw) ])
+    c = f.search(by.b)
+    assert(str(c.parent) == str(d.search(by.b).parent))
+    assert(map(str, c.path) == map(str, d.search(by.b).path))
+    assert(str(f.search(by.td).next) == '<td>2</td>')
+    for change in [ lambda: f.search(by.td).delegate.__delitem__(0),
+                    lambda: setattr(t.delegate, 'id', 'u'),
+                    lambda: f.search(by.td).delegate.__setitem__(0, 'x') ]:
+        try:
+            change()
+            assert(False)
+        except TypeError:
+            pass
+    p = parser()
+    p.frozen = True
+    e = p.parse(str(d))
+    assert(isinstance(e, frozen_entity) and str(e) == str(d))
+
+def tests_numpy():
+    d = testpage()
+    criteria = [ by.td, by.has_class, by.class_('price'), by.id('z'),
+                 by.token('class', 'b'), by.substring('para'),
+                 by.and_(by.td, by.class_('price')), by.or_(by.th, by.i),
+                 by.and_(by.p, lambda c: 'one' in str(c)),
+                 by.or_(by.b, lambda c: is_entity(c) and c.tag == 'em') ]
+    expected = [ map(str, d.findall(c)) for c in criteria ]
+    for vectorize in (False, True):
+        if vectorize and numpy is None:
+            break
+        f = d.freeze()
+        f.document.vectorize = vectorize
+        for c, strs in zip(criteria, expected):
+            assert(map(str, f.findall(c)) == strs)
+            assert(map(str, f.findall(c, max_depth=5)) ==
+                   map(str, d.findall(c, max_depth=5)))
+            # again, from the mask kept for the criterion
+            assert(map(str, f.findall(c)) == strs)
+        t = f.search(by.table)
+        assert(map(str, t.findall(by.td)) == map(str, d.findall(by.td)))
+        assert(len(t.findall(by.p)) == 0)
+
+def tests_prune():
+    d = testpage()
+    assert(len(d.findall(by.p)) == 3)
+    assert(len(d.findall(by.p, prune=skip_non_content)) == 2)
+    assert(len(d.findall(by.p, prune='object')) == 2)
+    assert(len(d.findall(by.p, prune=lambda c: c.tag == 'object')) == 2)
+    # pruned entities are still tested
+    assert(len(d.findall(by.tag('object'), prune='object')) == 1)
+    assert(len(d.findall(by.substring('</td>'))) == 1)
+    assert(len(d.findall(by.substring('</td>'), prune=skip_raw_text)) == 0)
+    outside_p = by.outside(by.p, 'object')
+    assert(len(d.findall(outside_p)) == 2)
+    assert(len(d.findall(by.and_(outside_p, by.has_class))) == 0)
+    # or_ prunes only what all of its criteria prune
+    assert(len(d.findall(by.or_(outside_p, by.i))) == 4)
+    assert(len(d.findall(by.or_(outside_p, by.outside(by.i, 'object')))) == 3)
+    assert(str(d.search(by.p, prune='object')) ==
+           str(d.search(by.p)))
+    for vectorize in (False, True):
+        f = d.freeze()
+        f.document.vectorize = vectorize and numpy is not None
+        for kw in [ dict(prune=skip_non_content), dict(prune='object'),
+                    dict(prune=lambda c: c.tag == 'object') ]:
+            assert(map(str, f.findall(by.p, **kw)) ==
+                   map(str, d.findall(by.p, **kw)))
+        assert(map(str, f.findall(outside_p)) == map(str, d.findall(outside_p)))
+    d.tree_index()
+    assert(len(d.findall(by.p, prune='object')) == 2)
+    assert(len(d.findall(outside_p)) == 2)
+
+def tests_cache_roots():
+    import gc
+    t = title('a')
+    b = body(p('x'))
+    doc = html(head(t), b)
+    doc.cache_rendering()
+    str(doc)
+    # turning a subtree off leaves its ancestors' caching on
+    b.cache_rendering(False)
+    t.append('B')
+    assert('<title>aB</title>' in str(doc))
+    gc.collect()
+    roots = len(render_caches)
+    for i in range(100):
+        e = html(body(p('x')))
+        e.cache_rendering()
+        str(e)
+    del e
+    gc.collect()
+    assert(len(render_caches) == roots)
+    doc.cache_rendering(False)
+    assert(len(render_caches) == roots - 1)
+    # one entity within two parents
+    x = span('x')
+    d = div(p(x), entities.b(x))
+    d.cache_rendering()
+    str(d)
+    x.append('Y')
+    assert(str(d) == '<div><p><span>xY</span></p><b><span>xY</span></b></div>')
+    # an entity moved to another parent
+    y = span('y')
+    p1 = p(y)
+    p2 = p()
+    d = div(p1, p2)
+    d.cache_rendering()
+    str(d)
+    p1.remove(y)
+    p2.append(y)
+    str(d)
+    y.append('Z')
+    assert(str(d) == '<div><p></p><p><span>yZ</span></p></div>')
+    d.cache_rendering(False)
+
+def tests_matches_bounded():
+    d = testpage()
+    # a bounded search covers matches nested within earlier ones
+    m = div(div(div(span('x'), id_='in'), id_='mid')).findall(by.div)
+    assert(len(m.findall(by.span, max_depth=1)) == 1)
+    assert(len(m.findall(by.div, max_depth=1)) == 1)
+    assert(len(m.findall(by.span, nest=0)) == 1)
+    assert(str(m.match(by.span)) == '<span>x</span>')
+    divs = d.findall(by.div)
+    assert(len(divs.findall(by.span, max_depth=1)) == 1)
+    assert(len(divs.findall(by.em, max_depth=2)) == 1)
+    # in
+    tds = d.findall(by.td)
+    assert(tds[2] in tds and d.search(by.td) in tds)
+    assert(tds[2].delegate in tds and td in tds)
+    assert('bold' in tds and 'para' not in tds)
+    assert(d.search(by.th) not in tds and d.search(by.th).delegate not in tds)
+    assert(table not in tds)
+    f = d.freeze()
+    ftds = f.findall(by.td)
+    assert(ftds[1].delegate in ftds and ftds[1] in ftds)
+    assert(f.search(by.th).delegate not in ftds)
+
+def tests_bulk_keys():
+    d = testpage()
+    tds = d.findall(by.td)
+    tds.update_attrs(lambda c: { 'id_': 1, 'id': 2 })
+    for c in tds:
+        assert(c.delegate._attributes[::2].count('id') == 1)
+        assert(c.delegate['id'] == 2 and ' id="2"' in str(c))
+    tds.set(class_='x', CLASS='y')
+    assert(list(d.search(by.td).delegate._attributes[::2]).count('class') == 1)
+    f = d.freeze()
+    for change in [ lambda m: m.set(id_='u'),
+                    lambda m: m.update_attrs(lambda c: { 'id': 'u' }),
+                    lambda m: m.wrap('div'), lambda m: m.remove() ]:
+        try:
+            change(f.findall(by.td))
+            assert(False)
+        except TypeError:
+            pass
+    assert(str(f) == str(d))
+
+def tests_iterparse_bounded():
+    import StringIO
+    rows = ''.join([ '  <tr><td>%d</td></tr>\n' % i for i in range(10000) ])
+    biggest = 0
+    for event, t in iterparse(StringIO.StringIO('<table>\n%s</table>' % rows),
+                              ('start', 'end'), discard=('tr',)):
+        if event == 'start' and t.tag == 'table':
+            table = t
+        elif event == 'end' and t.tag == 'tr':
+            biggest = max(biggest, len(table.contents))
+    assert(biggest < 2000)
+    assert(table.contents == [ '\n' ])
+
+def tests_fetch_stop():
+    import htmlbench
+    import time
+    class counted(dict):
+        def get(self, key, default=None):
+            self.requests += 1
+            return dict.get(self, key, default)
+    pages = counted([ ('/%d' % i, '<p>page %d' % i) for i in range(100) ])
+    pages.requests = 0
+    server, base = htmlbench.serve(pages, latency=0.01)
+    try:
+        found = fetch_and_parse([ base + '/%d' % i for i in range(100) ],
+                                workers=4, per_host=4)
+        found.next()
+        found.close()
+        time.sleep(0.2)
+        requests = pages.requests
+        assert(requests < 20)
+        time.sleep(0.2)
+        assert(pages.requests == requests)
+    finally:
+        server.shutdown()
+
+def tests_frozen_text():
+    d = testpage()
+    f = d.freeze()
+    b = f.search(by.body)
+    assert(b.as_text() == d.search(by.body).as_text())
+    assert(''.join(b.iter_text()) == b.as_text())
+    assert('para two' in b.as_text() and 'para two' in b)
+    assert('para' not in f and 'para' not in d)
+    e = f.search(by.p).delegate
+    assert('para one' in e and 'para two' not in e)
+    for c in f.findall(lambda c: is_entity(c)):
+        n = c.delegate.node
+        t = f.document.thaw(n)
+        assert(c.as_text() == t.as_text())
+        assert(repr(c.delegate) ==
+               '<%s.frozen_entity %d %s>' % (__name__, n, t.as_info()))
+    # quiet entities have no text
+    f = freeze(html(body(p('a'), object_('hidden', p('in')), 'b')))
+    assert(f.as_text() == 'ab' and f.search(by.body).as_text() == 'ab')
+    assert('hidden' not in f.search(by.body) and 'a' in f.search(by.body))
+
+def tests_attribute_values():
+    # values equal to attribute names are only values
+    e = parse('<th id_="class" class_="a" class="class">').search(by.th)
+    assert(e.delegate._attributes[::2].count('class') == 1)
+    assert(e.delegate['id'] == 'class' and e.delegate['tag'] == 'th')
+    assert(e.delegate['class'] in ('a', 'class'))
+    e = parse('<div lang="class" class_="a" class="b">').search(by.div)
+    assert(e.delegate['lang'] == 'class' and e.delegate['tag'] == 'div')
+    assert(e.delegate['class'] in ('a', 'b'))
+    assert(' lang="class"' in str(e) and ' class="' in str(e))
+    e = parse('<x-y title="tag" lang="tag">').search(by.tag('x-y'))
+    assert(e.tag == 'x-y' and e.delegate['title'] == 'tag')
+    e = div(lang='class', class_='a', title='tag')
+    assert(e.tag == 'div' and e['lang'] == 'class' and e['class'] == 'a')
+    assert(e['title'] == 'tag')
+    e = entity(tag='x-y', id_='tag', class_='id')
+    assert(e.tag == 'x-y' and e['id'] == 'tag' and e['class'] == 'id')
+    e = span(id_='class', class_='a', CLASS='b')
+    assert(e['id'] == 'class' and e['class'] in ('a', 'b'))
+    assert(e._attributes[::2].count('class') == 1)
+
+def tests_starttag_attributes():
+    # the tag, then the attributes in source order
+    e = parse('<div lang="x" id="y" title="class">').search(by.div)
+    assert(e.delegate._attributes ==
+           ('tag', 'div', 'lang', 'x', 'id', 'y', 'title', 'class'))
+    # a repeated attribute keeps its last value
+    e = parse('<td class="a" id="b" class_="c">').search(by.td).delegate
+    assert(e._attributes == ('tag', 'td', 'class', 'c', 'id', 'b'))
+    e = parse('<td class_="c" class="a">').search(by.td).delegate
+    assert(e._attributes == ('tag', 'td', 'class', 'a'))
+    # tag= overrides the tag, and an empty one ends at once
+    d = parse('<p tag="br">x')
+    assert(d.contents[0]._attributes is tag_pairs('br'))
+    assert(type(d.contents[0]) is p and d.contents[1:] == [ 'x' ])
+    e = parse('<x-y tag="i" tag="b" id="c">').contents[0]
+    assert(e.tag == 'b' and e._attributes == ('tag', 'b', 'id', 'c'))
+    assert(str(e) == '<b id="c"></b>')
+
+def tests_index_members():
+    import gc
+    d = testpage()
+    e = testpage()
+    index = d.tree_index()
+    other = e.tree_index()
+    # changes elsewhere leave the index alone
+    div().append('x')
+    e.search(by.td).delegate.append('x')
+    e.search(by.td).delegate.attributes['class'] = 'c'
+    assert(d.tree_index() is index and not index.stale())
+    assert(other.stale() and e.tree_index() is not other)
+    # attributes made after the index are part of it
+    cell = d.search(by.td).delegate
+    cell.attributes
+    assert(d.tree_index() is index)
+    cell.attributes['id'] = 'first'
+    assert(index.stale())
+    assert(str(d.search(by.id('first'))) == str(cell))
+    index = d.tree_index()
+    d.search(by.td).delegate.set_attributes([ ('id', 'again') ])
+    assert(index.stale() and len(d.findall(by.id('again'))) == 1)
+    index = d.tree_index()
+    del d.search(by.tr).delegate[0]
+    assert(index.stale() and len(d.findall(by.td)) == 4)
+    # stale and collected indexes drop out
+    assert(id(index) not in tree_indexes)
+    gc.collect()
+    live = len(tree_indexes)
+    e = other = None
+    gc.collect()
+    assert(len(tree_indexes) == live - 1)
+
+def tests_iterparse_text():
+    import StringIO
+    def discarded(source, tags):
+        for event, t in iterparse(StringIO.StringIO(source), discard=tags):
+            pass
+        return str(t)
+    assert(discarded('<p>Total price: <span>5</span> USD</p>', ('span',))
+           == '<p>Total price:  USD</p>')
+    assert(discarded('<ul>\n  <li>a</li>\n  <li>b</li>\n</ul>', ('li',))
+           == '<ul>\n</ul>')
+    assert(discarded('<div>x\n<b>y</b>\n \n<b>z</b>w</div>', ('b',))
+           == '<div>x\nw</div>')
+
+def tests_binary_values():
+    # unhashable attribute values get kinds of their own
+    e = div(p('a', data=[ 1, 2 ]), p('b', data=[ 1, 2 ]), p('c', class_='x'),
+            p('d', class_='x'))
+    f = loads(dumps(e))
+    assert(f == e and f.contents[0]['data'] == [ 1, 2 ])
+    assert(f.contents[0]._attributes is not f.contents[1]._attributes)
+    assert(f.contents[2]._attributes is f.contents[3]._attributes)
+    # loads() imports nothing and makes only entity classes
+    data = dumps(document(p('x')))
+    assert(type(loads(data)) is document)
+    for name in ('os:system', 'no_such_module:entity', __name__ + ':cursor',
+                 'no-such-tag'):
+        try:
+            loads(dumps_magic + marshal.dumps(
+                ([ name ], [ (0, ('tag', 'x')) ], [ 0, 0 ]), 2))
+            assert(False)
+        except ValueError:
+            pass
+
+def tests_lru_threads():
+    import random
+    cache = lru(16)
+    def work(seed):
+        r = random.Random(seed)
+        for i in xrange(20000):
+            key = r.randrange(40)
+            if cache.get(key) is None:
+                cache[key] = key
+    workers = [ threading.Thread(target=work, args=(i,)) for i in range(8) ]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    # the links still make one ring holding every entry once
+    keys = [ ]
+    link = cache.root[1]
+    while link is not cache.root and len(keys) <= 16:
+        keys.append(link[2])
+        link = link[1]
+    assert(sorted(keys) == sorted(cache.links) and len(keys) <= 16)
+    assert(cache.hits + cache.misses == 8 * 20000)
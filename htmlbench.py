@@ -0,0 +1,584 @@
+"""timings for html.py hot paths.
+
+    python htmlbench.py                 # run every benchmark
+    python htmlbench.py findall         # run the named benchmarks
+    python htmlbench.py --json FILE     # run suite(), results to FILE
+    python htmlbench.py --compare OLD NEW
+                                        # flag regressions between runs
+
+--size, --depth and --breadth set the suite()'s generated documents,
+--threshold the slowdown (0.1 = 10%) --compare counts as a regression.
+"""
+
+import sys
+import time
+
+import html
+from html import by
+
+def generate(rows, cols=4):
+    """a table-heavy document of roughly rows * cols * 3 nodes."""
+    return html.html(
+        html.head(html.title('benchmark')),
+        html.body(html.table(*[
+            html.tr(*[ html.td('cell %d.%d' % (r, c), class_='c%d' % c)
+                       for c in range(cols) ])
+            for r in range(rows) ])))
+
+def generate_tree(depth=6, breadth=4):
+    """nested divs, BREADTH children each, DEPTH levels, spans as leaves."""
+    def level(d, n):
+        if d == 0:
+            return html.span('leaf %d' % n, class_='leaf')
+        return html.div(*[ level(d - 1, n * breadth + i)
+                           for i in range(breadth) ], class_='level%d' % d)
+    return html.html(html.body(level(depth, 0)))
+
+def corpus(n=2000):
+    """sample pages: a table, an attribute heavy article and tag soup."""
+    table = str(generate(n // 4))
+    article = ''.join([
+        '<div class="post" id="p%d"><h2><a href="/p/%d" title="post %d">'
+        'Post %d</a></h2><p class="meta">by <span class="author">x</span>'
+        '<img src="/a/%d.png" width="32" height="32" alt=""></p>'
+        '<p>text <b>bold</b> <i>it</i> <a href="#c%d">comments</a></p>'
+        '</div>\n' % ((i,) * 6) for i in range(n) ])
+    soup = ''.join([
+        '<ul><li>item %d<li><font color=red>unclosed %d<p>para<p>para'
+        '<table><tr><td>%d<td>cell<tr><td>row</table>'
+        '<select><option>a<option selected>b</select></ul><br>\n'
+        % (i, i, i) for i in range(n // 2) ])
+    return [ ('table', table),
+             ('article', '<html><body>%s</body></html>' % article),
+             ('soup', '<html><body>%s</body></html>' % soup) ]
+
+def site_page(rows=200):
+    """a page like a site's: a busy head, navigation, inline scripts,
+    styles, comments and embeds around a table of ROWS rows."""
+    head = ''.join(
+        ['<title>site</title>']
+        + [ '<meta name="m%d" content="%d">' % (i, i) for i in range(20) ]
+        + [ '<link rel="stylesheet" href="/s%d.css">' % i for i in range(10) ]
+        + [ '<script src="/j%d.js"></script>' % i for i in range(10) ]
+        + [ '<style>.c%d { color: red }</style>' % i for i in range(5) ])
+    nav = '<ul class="nav">%s</ul>' % ''.join([
+        '<li><a href="/s%d"><span class="icon"></span>section %d</a>'
+        '<ul>%s</ul></li>' % (i, i, ''.join([
+            '<li><a href="/s%d/%d">page %d</a></li>' % (i, j, j)
+            for j in range(8) ])) for i in range(20) ])
+    widgets = ''.join([
+        '<!-- widget %d --><script>var w%d = { a: [ 1, 2 ] };</script>'
+        '<object data="/w%d.swf"><param name="q" value="1">'
+        '<embed src="/w%d.swf"></object>' % ((i,) * 4) for i in range(20) ])
+    return ('<html><head>%s</head><body>%s%s%s%s</body></html>'
+            % (head, nav, widgets, str(generate(rows).body.table), widgets))
+
+def timeit(fn, repeat=3):
+    """best wall clock time of REPEAT calls."""
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        fn()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def count_nodes(doc):
+    return len(list(doc.findall(lambda e: True)))
+
+def bench_findall(sizes=(500, 1000, 2000, 4000, 8000)):
+    """findall traversal time should grow linearly with document size."""
+    for depth_first in (True, False):
+        for rows in sizes:
+            doc = generate(rows)
+            nodes = count_nodes(doc)
+            elapsed = timeit(lambda: list(doc.findall(by.td,
+                                                      depth_first=depth_first)))
+            print '%-24s %7d nodes %8.3fs %6.2fus/node' % (
+                'findall depth_first=%d' % depth_first,
+                nodes, elapsed, elapsed / nodes * 1e6)
+
+class null_file:
+    def __init__(self):
+        self.bytes = 0
+    def write(self, s):
+        self.bytes += len(s)
+
+def bench_render(sizes=(2000, 8000, 32000)):
+    """str(doc) against streaming as_html(out) and the first fragment."""
+    for rows in sizes:
+        doc = generate(rows)
+        out = null_file()
+        as_str = timeit(lambda: str(doc))
+        as_stream = timeit(lambda: doc.as_html(out=out))
+        first_byte = timeit(lambda: doc.iter_html().next())
+        print '%-24s %7d bytes str %.3fs out= %.3fs first %.6fs' % (
+            'render', len(str(doc)), as_str, as_stream, first_byte)
+
+def bench_attributes(n=4000):
+    """as_html throughput on attribute heavy pages, and escape=True."""
+    built = html.html(html.body(*[
+        html.div(html.a('link %d' % i, href='/p/%d?a=1&b=2' % i,
+                        title='post "%d"' % i, class_='link'),
+                 html.img(src='/i/%d.png' % i, width=32, height=32, alt=''),
+                 'x < y & z', class_='post', id_='p%d' % i)
+        for i in range(n) ]))
+    pages = [ ('parsed', html.parse(corpus(n)[1][1])), ('built', built) ]
+    for name, doc in pages:
+        size = len(doc.as_html())
+        for escape in (False, True):
+            elapsed = timeit(lambda: doc.as_html(escape=escape))
+            print '%-24s %7d bytes %.3fs %6.2fMB/s' % (
+                'attributes %s escape=%d' % (name, escape), size, elapsed,
+                size / elapsed / 1e6)
+
+def legacy_and(*criteria):
+    """criterion.and_ before compilation, for comparison."""
+    and_lambda = lambda a, b: a and b
+    return lambda item: reduce(and_lambda, [ c(item) for c in criteria ])
+
+def legacy_or(*criteria):
+    """criterion.or_ before compilation, for comparison."""
+    or_lambda = lambda a, b: a or b
+    return lambda item: reduce(or_lambda, [ c(item) for c in criteria ])
+
+def bench_criteria(rows=8000):
+    """compiled and_/or_ against the reduce() lambdas they replaced."""
+    doc = generate(rows)
+    cases = [
+        ('and(td, class)', (by.td, by.class_('c2'))),
+        ('and(has_class, tr)', (by.has_class, by.tr)),
+        ('or(th, td, tr)', (by.th, by.td, by.tr)),
+        ]
+    for name, criteria in cases:
+        if name.startswith('and'):
+            legacy, compiled = legacy_and(*criteria), by.and_(*criteria)
+        else:
+            legacy, compiled = legacy_or(*criteria), by.or_(*criteria)
+        before = timeit(lambda: list(doc.findall(legacy)))
+        after = timeit(lambda: list(doc.findall(compiled)))
+        print '%-24s legacy %.3fs compiled %.3fs (%.2fx)' % (
+            name, before, after, before / after)
+
+def bench_index(rows=8000):
+    """tag/class lookups answered by tree_index against a full walk."""
+    doc = generate(rows)
+    indexed_doc = generate(rows)
+    indexed_doc.tree_index()
+    cases = [ ('tr', by.tr), ('class', by.class_('c2')), ('title', by.title) ]
+    for name, fn in cases:
+        walk = timeit(lambda: list(doc.findall(fn)))
+        indexed = timeit(lambda: list(indexed_doc.findall(fn)))
+        print '%-24s walk %.3fs indexed %.5fs' % (
+            'index ' + name, walk, indexed)
+    build = timeit(lambda: html.tree_index(doc))
+    print '%-24s %.3fs' % ('index build', build)
+
+def bench_select(rows=8000):
+    """one select() pass against the equivalent nested findall passes."""
+    doc = generate(rows)
+    def nested():
+        return [ td for table in doc.findall(by.table)
+                 for tr in table.findall(by.tr, nest=0)
+                 for td in tr.findall(by.class_('c2')) ]
+    passes = timeit(nested)
+    selected = timeit(lambda: list(doc.select('table > tr td.c2')))
+    print '%-24s nested %.3fs select %.3fs' % ('select', passes, selected)
+
+def bench_contains(rows=8000):
+    """'TEXT' in entity, stopping early, against searching as_text()."""
+    doc = generate(rows).body
+    for name, text in (('early', 'cell 0.1'), ('late', 'cell %d.3' % (rows - 1)),
+                       ('missing', 'no such text')):
+        full = timeit(lambda: text in doc.as_text())
+        streamed = timeit(lambda: text in doc)
+        print '%-24s as_text %.4fs streamed %.4fs' % (
+            'contains ' + name, full, streamed)
+
+def bench_matches(rows=8000):
+    """the first results and the count, lazily against a full list()."""
+    doc = generate(rows)
+    full = timeit(lambda: list(doc.findall(by.td))[:10])
+    lazy = timeit(lambda: doc.findall(by.td)[:10])
+    print '%-24s list %.4fs lazy %.4fs' % ('matches [:10]', full, lazy)
+    found = doc.findall(by.td)
+    first = timeit(lambda: len(found), repeat=1)
+    again = timeit(lambda: len(found))
+    print '%-24s first %.4fs cached %.6fs' % ('matches len', first, again)
+
+def bench_bulk(rows=8000):
+    """per-cursor edits against the matches bulk operations."""
+    def loop_set(found):
+        for td in found:
+            td.width = '10'
+    def bulk_set(found):
+        found.set(width='10')
+    def loop_remove(found):
+        for td in found[::-1]:
+            del td.parent[td.which_child]
+    def bulk_remove(found):
+        found.remove()
+    def edit_time(fn, criterion):
+        # the search is done beforehand, only the edits are timed
+        best = None
+        for i in range(3):
+            found = generate(rows).findall(criterion)
+            found.fill()
+            elapsed = timeit(lambda: fn(found), repeat=1)
+            if best is None or elapsed < best:
+                best = elapsed
+        return best
+    for name, loop, bulk, criterion in (
+        ('set', loop_set, bulk_set, by.td),
+        ('remove', loop_remove, bulk_remove, by.class_('c2'))):
+        print '%-24s loop %.3fs bulk %.3fs' % (
+            'bulk ' + name, edit_time(loop, criterion),
+            edit_time(bulk, criterion))
+
+def bench_cache(rows=8000):
+    """str() and as_text() after editing one cell, cached or not."""
+    for cached in (False, True):
+        doc = generate(rows)
+        if cached:
+            doc.cache_rendering()
+        str(doc)
+        doc.as_text()
+        cells = list(doc.findall(by.td))
+        def edit():
+            cell = cells[len(cells) // 2]
+            cell.class_ = cell.class_ + 'x'
+            str(doc)
+            doc.as_text()
+        print '%-24s %7d cells %.4fs per edit' % (
+            'cache_rendering=%d' % cached, len(cells), timeit(edit))
+
+def deep_size(root):
+    """bytes held by the entity tree or frozen_document under ROOT,
+    shared objects once."""
+    seen = set()
+    total = 0
+    work = [ root ]
+    while work:
+        o = work.pop()
+        if id(o) in seen:
+            continue
+        seen.add(id(o))
+        total += sys.getsizeof(o)
+        if isinstance(o, html.entity):
+            work.append(o.contents)
+            work.append(o._attributes)
+        elif isinstance(o, html.frozen_document):
+            work.extend([ getattr(o, name) for name in o.columns ])
+            work.extend([ o.attribute_values, o.text, o.tag_names,
+                          o.tag_ids ])
+        elif isinstance(o, (list, tuple)):
+            work.extend(o)
+        elif isinstance(o, dict):
+            work.extend(o.keys())
+            work.extend(o.values())
+    return total
+
+def bench_memory(rows=8000):
+    """bytes per entity, compact against every attributes dict made."""
+    doc = html.parse(str(generate(rows)))
+    entities = [ c.delegate for c in doc.findall(html.is_entity) ]
+    compact = deep_size(doc)
+    for e in entities:
+        e.attributes
+    materialized = deep_size(doc)
+    print '%-24s %7d entities compact %dB/entity dicts %dB/entity' % (
+        'memory', len(entities), compact / len(entities),
+        materialized / len(entities))
+
+def bench_frozen():
+    """memory and findall() of frozen_documents against entity trees.
+
+    The frozen times are of a first search, numpy ones without
+    node_mask()s made earlier: with numpy installed and vectorize on.
+    """
+    criteria = [ ('td', by.td), ('and', by.and_(by.a, by.has_title)),
+                 ('substring', by.substring('unclosed 1')),
+                 ('lambda', lambda c: html.is_entity(c) and c.get('class') == 'meta') ]
+    for name, page in corpus():
+        doc = html.parse(page)
+        frozen = doc.freeze()
+        nodes = len(frozen.document)
+        print '%-24s %7d nodes %dB/node frozen %dB/node freeze %.3fs' % (
+            'memory ' + name, nodes, deep_size(doc) / nodes,
+            deep_size(frozen.document) / nodes, timeit(doc.freeze))
+        for label, fn in criteria:
+            found = len(doc.findall(fn))
+            times = [ timeit(lambda: len(doc.findall(fn))) ]
+            for vectorize in (False, True):
+                frozen.document.vectorize = vectorize
+                frozen.document.masks.clear()
+                times.append(timeit(lambda: len(frozen.findall(fn)), 1))
+            print '%-24s %7d found %.4fs frozen %.4fs numpy %.4fs' % (
+                ('findall %s %s' % (label, name), found) + tuple(times))
+
+def bench_prune(rows=200):
+    """nodes visited and time of findall() and search() on site_page(),
+    pruned and not."""
+    doc = html.parse(site_page(rows))
+    not_content = html.skip_non_content | frozenset(('ul',))
+    cases = [
+        ('findall td', lambda **k: len(doc.findall(by.td, **k))),
+        ('findall td outside', lambda **k: len(doc.findall(
+            by.outside(by.td, *not_content), **k))),
+        ('findall substring', lambda **k: len(doc.findall(
+            by.substring('cell 1.'), **k))),
+        ('search td', lambda **k: doc.search(by.td, **k)),
+        ]
+    for name, fn in cases:
+        for prune in (None, not_content):
+            with html.stats:
+                fn(prune=prune)
+            visited = html.stats.counters.get('findall nodes visited', 0)
+            print '%-24s %7d visited %.4fs' % (
+                name + (prune and ' pruned' or ''), visited,
+                timeit(lambda: fn(prune=prune)))
+
+def bench_parse():
+    """parse throughput over the corpus() pages."""
+    for name, page in corpus():
+        elapsed = timeit(lambda: html.parse(page))
+        print '%-24s %7d bytes %.3fs %6.2fMB/s' % (
+            'parse ' + name, len(page), elapsed, len(page) / elapsed / 1e6)
+
+def bench_dumps():
+    """html.loads() against parsing and unpickling the corpus() pages."""
+    import cPickle
+    for name, page in corpus():
+        doc = html.parse(page)
+        data = doc.dumps()
+        pickled = cPickle.dumps(doc, 2)
+        print '%-24s %7d bytes %.3fs' % (
+            'parse ' + name, len(page), timeit(lambda: html.parse(page)))
+        print '%-24s %7d bytes %.3fs' % (
+            'cPickle.loads ' + name, len(pickled),
+            timeit(lambda: cPickle.loads(pickled)))
+        print '%-24s %7d bytes %.3fs' % (
+            'loads ' + name, len(data), timeit(lambda: html.loads(data)))
+
+def bench_malformed(sizes=(1000, 2000, 4000, 8000)):
+    """deeply nested, never closed markup full of stray end tags."""
+    for depth in sizes:
+        page = ('<div><span>x</p>' * depth) + ('</em>' * depth)
+        elapsed = timeit(lambda: html.parse(page))
+        print '%-24s %7d deep %.3fs %6.2fus/tag' % (
+            'parse malformed', depth, elapsed, elapsed / (depth * 4) * 1e6)
+
+def bench_parse_many(docs=32, rows=500):
+    """a batch parsed one after another against parse_many()'s pool."""
+    sources = [ str(generate(rows)) ] * docs
+    serial = timeit(lambda: map(html.parse, sources), repeat=1)
+    pooled = timeit(lambda: list(html.parse_many(sources)), repeat=1)
+    print '%-24s %7d docs serial %.3fs pool %.3fs (%.2fx)' % (
+        'parse_many', docs, serial, pooled, serial / pooled)
+
+def serve(pages, latency=0.02):
+    """a local keep-alive HTTP server for PAGES, as (SERVER, BASE_URL).
+
+    Every response waits LATENCY seconds, standing in for the network.
+    """
+    import BaseHTTPServer
+    import SocketServer
+    import threading
+    class handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        def do_GET(self):
+            time.sleep(latency)
+            page = pages.get(self.path)
+            if page is None:
+                self.send_response(404)
+                page = 'not found'
+            else:
+                self.send_response(200)
+            self.send_header('Content-Type', 'text/html')
+            self.send_header('Content-Length', str(len(page)))
+            self.end_headers()
+            self.wfile.write(page)
+        def log_message(self, *args):
+            pass
+    class server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+    s = server(('127.0.0.1', 0), handler)
+    t = threading.Thread(target=s.serve_forever)
+    t.setDaemon(True)
+    t.start()
+    return s, 'http://127.0.0.1:%d' % s.server_address[1]
+
+def bench_fetch(docs=64, rows=50):
+    """urlopen() one URL at a time against fetch_and_parse()."""
+    page = str(generate(rows))
+    pages = dict([ ('/%d' % i, page) for i in range(docs) ])
+    server, base = serve(pages)
+    urls = [ base + path for path in sorted(pages) ] + [ base + '/missing' ]
+    try:
+        serial = timeit(lambda: map(html.urlopen, urls[:-1]), repeat=1)
+        results = [ ]
+        pipelined = timeit(lambda: results.extend(
+            html.fetch_and_parse(urls, per_host=8)), repeat=1)
+    finally:
+        server.shutdown()
+    errors = len([ error for url, doc, error in results if error ])
+    print '%-24s %7d urls serial %.3fs pipelined %.3fs (%d errors)' % (
+        'fetch', docs, serial, pipelined, errors)
+
+def peak_rss(fn):
+    """(SECONDS, KB) FN takes and adds to peak RSS, run in a child."""
+    import os
+    import resource
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_end)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        fn()
+        elapsed = time.time() - start
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        os.write(write_end, '%f %d' % (elapsed, after - before))
+        os._exit(0)
+    os.close(write_end)
+    result = os.read(read_end, 100)
+    os.close(read_end)
+    os.waitpid(pid, 0)
+    elapsed, kb = result.split()
+    return float(elapsed), int(kb)
+
+def bench_openfile(rows=32000):
+    """openfile() reading the whole file against memory mapping it."""
+    import os
+    import tempfile
+    fd, path = tempfile.mkstemp(suffix='.html')
+    try:
+        os.write(fd, str(generate(rows)))
+        os.close(fd)
+        size = os.path.getsize(path)
+        for mmap in (False, True):
+            elapsed, kb = peak_rss(lambda: html.openfile(path, mmap=mmap))
+            print '%-24s %7d bytes %.3fs peak rss +%dKB' % (
+                'openfile mmap=%d' % mmap, size, elapsed, kb)
+    finally:
+        os.remove(path)
+
+def navigate(doc):
+    """visits every td by cursor: up to the table and across siblings."""
+    for td in doc.iter_findall(by.td):
+        c = td
+        while c.parent is not None:
+            c = c.parent
+        c = td
+        while c.which_child > 0:
+            c = c.previous
+        try:
+            while True:
+                c = c.next
+        except IndexError:
+            pass
+
+def mutate(doc):
+    """appends to, edits and restores every tr."""
+    for tr in doc.findall(by.tr):
+        tr.append(html.td('new'))
+        tr.bgcolor = 'white'
+        del tr[-1]
+        del tr.attributes['bgcolor']
+
+def suite(size=4000, depth=6, breadth=4, repeat=3):
+    """{ NAME: SECONDS } for the parse, search, render and mutate paths.
+
+    SIZE rows of generate() and a generate_tree(DEPTH, BREADTH) are
+    searched and rendered, the corpus() fixtures parsed.
+    """
+    table = generate(size)
+    tree = generate_tree(depth, breadth)
+    pages = corpus(size // 2) + [ ('tree', str(tree)) ]
+    cases = [ ('parse ' + name, lambda page=page: html.parse(page))
+              for name, page in pages ]
+    data = table.dumps()
+    cases += [ ('dumps', lambda: table.dumps()),
+               ('loads', lambda: html.loads(data)) ]
+    criteria = [ ('td', by.td), ('class', by.class_('c2')),
+                 ('and', by.and_(by.td, by.class_('c2'))),
+                 ('or', by.or_(by.th, by.td)), ('lambda', lambda c: True) ]
+    cases += [ ('findall ' + name, lambda fn=fn: len(table.findall(fn)))
+               for name, fn in criteria ]
+    cases += [
+        ('findall tree', lambda: len(tree.findall(by.class_('leaf')))),
+        ('select', lambda: len(table.select('tr > td.c2'))),
+        ('as_html', lambda: table.as_html()),
+        ('as_html tree', lambda: tree.as_html()),
+        ('as_text', lambda: table.as_text()),
+        ('as_python', lambda: table.as_python()),
+        ('navigate', lambda: navigate(table)),
+        ('mutate', lambda: mutate(generate(size))),
+        ]
+    results = { }
+    for name, fn in cases:
+        results[name] = timeit(fn, repeat)
+    return results
+
+def write_results(results, file):
+    import json
+    json.dump({ 'html': html.__VERSION__, 'python': sys.version.split()[0],
+                'results': results }, file, indent=1, sort_keys=True)
+    file.write('\n')
+
+def read_results(path):
+    import json
+    return json.load(open(path))['results']
+
+def compare(old, new, threshold=0.1):
+    """prints NEW against OLD timings => how many got THRESHOLD slower."""
+    regressions = 0
+    for name in sorted(set(old) | set(new)):
+        if name not in old or name not in new:
+            print '%-24s only in %s' % (name, name in old and 'old' or 'new')
+            continue
+        ratio = new[name] / max(old[name], 1e-9)
+        if ratio > 1 + threshold:
+            flag = 'REGRESSION'
+            regressions += 1
+        elif ratio < 1 - threshold:
+            flag = 'faster'
+        else:
+            flag = ''
+        print '%-24s %.4fs => %.4fs %5.2fx %s' % (
+            name, old[name], new[name], ratio, flag)
+    return regressions
+
+benchmarks = [ 'findall', 'render', 'attributes', 'criteria', 'index',
+               'select', 'contains', 'matches', 'bulk', 'cache', 'memory',
+               'frozen', 'prune', 'parse', 'dumps', 'malformed',
+               'parse_many', 'fetch', 'openfile' ]
+
+def main(argv):
+    import optparse
+    options = optparse.OptionParser(usage=__doc__.split('\n\n')[1])
+    options.add_option('--json', metavar='FILE')
+    options.add_option('--compare', nargs=2, metavar='OLD NEW')
+    options.add_option('--threshold', type='float', default=0.1)
+    options.add_option('--size', type='int', default=4000)
+    options.add_option('--depth', type='int', default=6)
+    options.add_option('--breadth', type='int', default=4)
+    options, names = options.parse_args(argv[1:])
+    if options.compare:
+        old, new = map(read_results, options.compare)
+        if compare(old, new, options.threshold):
+            return 1
+    elif options.json:
+        results = suite(options.size, options.depth, options.breadth)
+        if options.json == '-':
+            write_results(results, sys.stdout)
+        else:
+            write_results(results, open(options.json, 'w'))
+    else:
+        for name in names or benchmarks:
+            globals()['bench_' + name]()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))